@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+# Keyspace report of RedisPersistence and RedisStats: key count, size distribution (MEMORY USAGE)
+# and idle time histogram (OBJECT IDLETIME) per store and per quest_type of user sessions
+# Keys are read by SCAN and pipelined batches, so Redis is not blocked
+#
+# Compaction, run it when the bot is stopped or pass --invalidate to bots with CACHE_INVALIDATION:
+#   --drop-orphans  delete empty sessions and ended conversations (state null)
+#   --trim          drop question fields of other games left in sessions
+#   --rewrite       rewrite sessions in the current format of RedisSession
+# Reading values resets idle time of the keys, --keep-idle doesn't read them
+# (no per quest_type report, no orphans, no trim and rewrite)
+#
+#   python analyze_keys.py redis://127.0.0.1 [--bot-id ID] [--cluster] [--drop-orphans] [--trim] [--rewrite] [--dry-run]
+
+import argparse
+import json
+from bisect import bisect_right
+from collections import Counter
+from itertools import chain
+from typing import Dict, List, Optional, Tuple
+
+from redis import StrictRedis
+
+from redis_util import CacheInvalidator
+from redis_pool import create_redis, create_redis_cluster
+from session import RedisSession, quests
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# question fields of all games, the ones not of the session's game are legacy
+QUEST_FIELDS = set(chain.from_iterable(cls.fields for cls in quests.values()))
+
+SIZE_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+IDLE_BUCKETS = [60, 3600, 86400, 7 * 86400, 30 * 86400]
+IDLE_NAMES = ['1m', '1h', '1d', '7d', '30d']
+
+
+def human_size(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+class KeyStats(object):
+    """
+        Count, sizes and idle times of a group of keys
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sizes: List[int] = []
+        self.idle = Counter()
+
+    def add(self, size: Optional[int], idle: Optional[int]) -> None:
+        self.count += 1
+        if size is not None:
+            self.sizes.append(size)
+        if idle is not None:
+            self.idle[bisect_right(IDLE_BUCKETS, idle)] += 1
+
+    def report(self, name: str) -> List[str]:
+        lines = [f'{name:30} {self.count:9} keys']
+        if self.sizes:
+            sizes = sorted(self.sizes)
+            p = [sizes[min(len(sizes) - 1, int(len(sizes) * q))] for q in (0.5, 0.9, 0.99)]
+            lines[0] += (f'  {human_size(sum(sizes)):>10}  p50 {human_size(p[0])}, p90 {human_size(p[1])}, '
+                         f'p99 {human_size(p[2])}, max {human_size(sizes[-1])}')
+            histogram = Counter(bisect_right(SIZE_BUCKETS, size) for size in sizes)
+            lines.append('    size: ' + ', '.join(
+                f'{"<" + str(SIZE_BUCKETS[i]) if i < len(SIZE_BUCKETS) else ">=" + str(SIZE_BUCKETS[-1])} {n}'
+                for i, n in sorted(histogram.items())))
+        if self.idle:
+            lines.append('    idle: ' + ', '.join(
+                f'{"<" + IDLE_NAMES[i] if i < len(IDLE_NAMES) else ">=" + IDLE_NAMES[-1]} {n}'
+                for i, n in sorted(self.idle.items())))
+        return lines
+
+
+class KeyspaceAnalyzer(object):
+    """
+        Scans keys of the bot (by prefix of bot_id), groups them by store and quest_type of user_data,
+        finds orphans and legacy sessions and compacts them when asked
+        Missing or empty user_data doesn't mean the conversation is dead (session of a new user may be
+        not written yet), so only ended conversations are orphans
+    """
+
+    def __init__(self, redis: StrictRedis, bot_id: Optional[str] = None, batch_size: int = 500,
+                 keep_idle: bool = False, drop_orphans: bool = False, trim: bool = False, rewrite: bool = False,
+                 dry_run: bool = False, invalidate: bool = False):
+        self._redis = redis
+        self.id_prefix = f'bot_{bot_id}:' if bot_id else ''
+        self.batch_size = batch_size
+        self.keep_idle = keep_idle
+        self.drop_orphans = drop_orphans
+        self.trim = trim and not keep_idle
+        self.rewrite = rewrite and not keep_idle
+        self.dry_run = dry_run
+        self._invalidator = CacheInvalidator(redis, f'{self.id_prefix}invalidate') if invalidate else None
+
+        self.stats: Dict[str, KeyStats] = {}
+        self.actions = Counter()
+
+    def store_of(self, key_id: str) -> str:
+        name = key_id[len(self.id_prefix):]
+        if name.startswith('conversations:'):
+            return ':'.join(name.split(':', 2)[:2])
+        for store in ('stats:top', 'stats:streak', 'stats:names'):
+            if name.startswith(store):
+                return store
+        store = name.split(':', 1)[0]
+        return store if store in ('user_data', 'chat_data', 'bot_data', 'stats') else 'other'
+
+    def group(self, store: str, group: str, size: Optional[int], idle: Optional[int]) -> None:
+        for name in (store, group) if group else (store,):
+            self.stats.setdefault(name, KeyStats()).add(size, idle)
+
+    def run(self) -> None:
+        batch = []
+        for key_id in self._redis.scan_iter(match=f'{self.id_prefix}*', count=self.batch_size):
+            batch.append(key_id)
+            if len(batch) >= self.batch_size:
+                self.process(batch)
+                batch = []
+        if batch:
+            self.process(batch)
+
+    def process(self, key_ids: List[str]) -> None:
+        stores = [self.store_of(key_id) for key_id in key_ids]
+
+        # idle times first: reading values resets them
+        pipe = self._redis.pipeline(transaction=False)
+        for key_id in key_ids:
+            pipe.object('idletime', key_id)
+            pipe.memory_usage(key_id)
+        reads = []
+        for key_id, store in zip(key_ids, stores):
+            if not self.keep_idle and (store in ('user_data', 'chat_data') or store.startswith('conversations:')):
+                pipe.get(key_id)
+                reads.append(key_id)
+        results = pipe.execute(raise_on_error=False)
+        results = [None if isinstance(result, Exception) else result for result in results]
+
+        values = {}
+        position = 2 * len(key_ids)
+        for key_id in reads:
+            values.setdefault(key_id, []).append(results[position])
+            position += 1
+
+        pipe = self._redis.pipeline(transaction=False)
+        for index, (key_id, store) in enumerate(zip(key_ids, stores)):
+            idle, size = results[2 * index], results[2 * index + 1]
+            read = values.get(key_id, ())
+            group, action, value = self.inspect(key_id, store, read)
+            if size is None and read and isinstance(read[-1], str):
+                size = len(read[-1])
+            self.group(store, group, size, idle)
+            if action:
+                self.actions[action] += 1
+                if not self.dry_run:
+                    self.apply(pipe, key_id, value)
+        if self.dry_run:
+            return
+        if self._invalidator is None:
+            pipe.execute()
+        else:
+            self._invalidator.execute(pipe)
+
+    def inspect(self, key_id: str, store: str, values: list) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """
+        (group, action, value to write or None to delete) of the key
+        """
+        if store.startswith('conversations:'):
+            if values and values[0] == 'null':
+                return None, 'orphan' if self.drop_orphans else None, None
+            return None, None, None
+
+        if not values or values[0] is None:
+            return None, None, None
+        value = values[0]
+        if value == '{}':
+            return f'{store}:empty' if store == 'user_data' else None, 'orphan' if self.drop_orphans else None, None
+        if store != 'user_data':
+            return None, None, None
+
+        try:
+            data = json.loads(value)
+        except ValueError:
+            return 'user_data:broken', None, None
+        group = f'user_data:{data.get("quest_type") or data.get("choice") or "none"}'
+        if not (self.trim or self.rewrite):
+            return group, None, None
+
+        session = RedisSession(self._redis, key_id, {'choice': None})
+        session.load(value)
+        action = None
+        if self.trim:
+            legacy = [field for field in session.extra or () if field in QUEST_FIELDS]
+            for field in legacy:
+                del session[field]
+            if legacy:
+                action = 'trim'
+        # dump() doesn't skip unchanged values without invalidator, so compare with what is stored
+        new_value = session.dump()
+        if new_value is None or new_value == value:
+            return group, None, None
+        if action is None:
+            action = 'rewrite' if self.rewrite else None
+        return group, action, new_value
+
+    def apply(self, pipe, key_id: str, value: Optional[str]) -> None:
+        if value is None:
+            if self._invalidator is None:
+                pipe.delete(key_id)
+            else:
+                self._invalidator.delete(key_id, pipe)
+        elif self._invalidator is None:
+            pipe.set(key_id, value, xx=True)
+        else:
+            self._invalidator.set(key_id, value, pipe)
+
+    def report(self) -> List[str]:
+        lines = []
+        for name in sorted(self.stats):
+            lines += self.stats[name].report(f'  {name}' if name.startswith('user_data:') else name)
+        if self.actions:
+            lines.append(f'{"to do" if self.dry_run else "done"}: '
+                         + ', '.join(f'{action} {n}' for action, n in sorted(self.actions.items())))
+        return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report and compact Redis keys of the bot')
+    parser.add_argument('redis_url', help='for example redis://127.0.0.1')
+    parser.add_argument('--bot-id', help='bot_id of RedisPersistence')
+    parser.add_argument('--cluster', action='store_true', help='redis_url is a node of Redis Cluster')
+    parser.add_argument('--batch', type=int, default=500, help='keys per SCAN and per pipeline')
+    parser.add_argument('--keep-idle', action='store_true', help="don't read values, so idle time is kept")
+    parser.add_argument('--drop-orphans', action='store_true', help='delete empty and orphaned keys')
+    parser.add_argument('--trim', action='store_true', help='drop fields of other games from sessions')
+    parser.add_argument('--rewrite', action='store_true', help='rewrite sessions in the current format')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be changed')
+    parser.add_argument('--invalidate', action='store_true', help='publish changes to bots with CACHE_INVALIDATION')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    redis = create_redis_cluster(args.redis_url) if args.cluster else create_redis(args.redis_url)
+    analyzer = KeyspaceAnalyzer(redis, args.bot_id, args.batch, keep_idle=args.keep_idle,
+                                drop_orphans=args.drop_orphans, trim=args.trim, rewrite=args.rewrite,
+                                dry_run=args.dry_run, invalidate=args.invalidate)
+    analyzer.run()
+    print('\n'.join(analyzer.report()))
+
+
+if __name__ == '__main__':
+    main()
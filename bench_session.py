@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Memory of cached user sessions: RedisDict vs RedisSession per 100k sessions
+# Sessions are made by the games of number.py and loaded from json like they are read from Redis,
+# so Redis server is not needed: python bench_session.py [sessions]
+
+import gc
+import json
+import sys
+import tracemalloc
+from random import choice
+
+from redis import StrictRedis
+
+import number
+from redis_util import RedisDict, prepare_obj_for_json
+from session import RedisSession
+
+
+def make_sessions(n):
+    sessions = []
+    for _ in range(n):
+        name, new_quest = choice([
+            ('multi1', number.new_multi1),
+            ('multi2', number.new_multi2),
+            ('multi3', number.new_multi3),
+            ('two_actions', number.new_two_actions),
+        ])
+        quest = new_quest()
+        session = {'choice': name, **quest, 'answer_keys': number.answer_keys(quest)}
+        sessions.append(json.dumps(prepare_obj_for_json(session)))
+    return sessions
+
+
+def measure(cls, sessions):
+    redis = StrictRedis()
+    gc.collect()
+    tracemalloc.start()
+    objects = []
+    for user_id, serialized_value in enumerate(sessions):
+        obj = cls(redis, f'user_data:{user_id}', {'choice': 'multi1'})
+        obj.load(serialized_value)
+        objects.append(obj)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert json.loads(json.dumps(prepare_obj_for_json(objects[0].to_dict()))) == json.loads(sessions[0])
+    return size
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sessions = make_sessions(n)
+    payload = sum(map(len, sessions))
+    print(f'{n} sessions, json payload {payload / 2**20:.1f} MiB')
+    for cls in (RedisDict, RedisSession):
+        size = measure(cls, sessions)
+        print(f'{cls.__name__:12} {size / 2**20:8.1f} MiB  {size / n:6.0f} bytes/session  '
+              f'{size / n * 100000 / 2**20:8.1f} MiB/100k')
+
+
+if __name__ == '__main__':
+    main()
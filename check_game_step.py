@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Manual check of GAME_STEP_SCRIPT (RedisPersistence.game_step, ATOMIC_STEP) on real Redis: fakeredis has no cjson
+# Right and wrong answer of every game, with answer_keys in the session and without them
+# (sessions asked before ATOMIC_STEP was on). Keys of the bot_check_game_step bot are written and deleted
+#
+#   python check_game_step.py redis://127.0.0.1
+
+import json
+import sys
+
+import number
+from redis_pool import create_redis
+from redis_util import prepare_obj_for_json
+from redispersistence import RedisPersistence
+from session import RedisSession
+
+GAMES = [
+    ('multi1', number.new_multi1),
+    ('multi2', number.new_multi2),
+    ('multi3', number.new_multi3),
+    ('two_actions', number.new_two_actions),
+]
+
+
+def right_text(quest):
+    """ ответ, который ввел бы пользователь """
+    if 'answers' in quest:
+        return '\n'.join(f'{n} x {m}' for n, m in quest['answers'][0])
+    return quest['right_answer']
+
+
+def check(redis, persistence, user_id, name, quest, with_keys, correct):
+    user_data = persistence.get_user_data()[user_id]
+    session = {'choice': name, **quest}
+    if with_keys:
+        session['answer_keys'] = number.answer_keys(quest)
+    redis.set(user_data.key_id, json.dumps(prepare_obj_for_json(session)))
+
+    answer_key, _ = number.step_games[name]
+    ans = right_text(quest) if correct else '1 x 1'
+    result = persistence.game_step(number.CONVERSATION, (user_id, user_id), user_id, user_data, name,
+                                   answer_key(ans), {}, number.CHOOSING)
+    ok = result[:2] == (True, correct)
+    print(f'{"ok  " if ok else "FAIL"} {name:12} answer_keys={with_keys!s:5} correct={correct!s:5} -> {result[:2]}')
+    return ok
+
+
+def main():
+    redis = create_redis(sys.argv[1] if len(sys.argv) > 1 else 'redis://127.0.0.1')
+    persistence = RedisPersistence(redis, bot_id='check_game_step', user_data_class=RedisSession)
+    user_id = 1
+    ok = True
+    try:
+        for name, new_quest in GAMES:
+            quest = new_quest()
+            for with_keys in (True, False):
+                for correct in (True, False):
+                    ok = check(redis, persistence, user_id, name, quest, with_keys, correct) and ok
+    finally:
+        keys = redis.keys(f'{persistence.id_prefix}*')
+        if keys:
+            redis.delete(*keys)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
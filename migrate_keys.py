@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Move keys of RedisPersistence and RedisStats between plain layout and Redis Cluster hash tag layout
+# (hash_tags=True): user_data:{uid}, chat_data:{cid}, conversations:name:{uid}:"(cid, uid)", stats:{uid}
+# Stop the bot before migration. Keys are moved by DUMP/RESTORE, so it works across cluster slots,
+# key already existing in the target layout is not replaced and left with the old one.
+#
+#   python migrate_keys.py redis://127.0.0.1 [--bot-id ID] [--reverse] [--dry-run] [--cluster]
+
+import argparse
+from typing import Iterator, List, Tuple
+
+from redis import StrictRedis
+
+from redis_util import RedisDictStore, RedisSimpleStore, hash_tag
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def connect(redis_url: str, cluster: bool) -> StrictRedis:
+    # without decode_responses: DUMP returns binary
+    if cluster:
+        from rediscluster import RedisCluster
+        return RedisCluster.from_url(redis_url, skip_full_coverage_check=True)
+    return StrictRedis.from_url(redis_url)
+
+
+def is_tagged(store_key_id: str, key_id: str) -> bool:
+    return key_id[len(store_key_id) + 1:].startswith('{')
+
+
+def scan(redis: StrictRedis, pattern: str, batch: int) -> Iterator[str]:
+    for key_id in redis.scan_iter(match=pattern, count=batch):
+        yield key_id.decode() if isinstance(key_id, bytes) else key_id
+
+
+def store_moves(redis: StrictRedis, store_cls, key_id: str, reverse: bool, batch: int) -> Iterator[Tuple[str, str]]:
+    """
+    (old key, new key) of the store, conversion is done by store's own id2key/key2id
+    """
+    source = store_cls(redis, key_id, hash_tags=reverse)
+    target = store_cls(redis, key_id, hash_tags=not reverse)
+    for old in scan(redis, f'{key_id}:*', batch):
+        if is_tagged(key_id, old) == reverse:
+            yield old, target.key2id(source.id2key(old))
+
+
+def conversation_names(redis: StrictRedis, prefix: str, batch: int) -> List[str]:
+    key_id = f'{prefix}conversations'
+    return sorted({old[len(key_id) + 1:].split(':', 1)[0] for old in scan(redis, f'{key_id}:*', batch)})
+
+
+def stats_moves(redis: StrictRedis, prefix: str, reverse: bool, batch: int) -> Iterator[Tuple[str, str]]:
+    key_id = f'{prefix}stats'
+    for old in scan(redis, f'{key_id}:*', batch):
+        user_id = old[len(key_id) + 1:]
+        if reverse and user_id.startswith('{') and user_id.endswith('}'):
+            yield old, f'{key_id}:{user_id[1:-1]}'
+        elif not reverse and user_id.lstrip('-').isdecimal():
+            yield old, f'{key_id}:{hash_tag(user_id)}'
+
+
+def all_moves(redis: StrictRedis, prefix: str, reverse: bool, batch: int) -> Iterator[Tuple[str, str]]:
+    for store in ('user_data', 'chat_data'):
+        yield from store_moves(redis, RedisDictStore, f'{prefix}{store}', reverse, batch)
+    for name in conversation_names(redis, prefix, batch):
+        yield from store_moves(redis, RedisSimpleStore, f'{prefix}conversations:{name}', reverse, batch)
+    yield from stats_moves(redis, prefix, reverse, batch)
+
+
+def move_batch(redis: StrictRedis, moves: List[Tuple[str, str]]) -> Tuple[int, int]:
+    pipe = redis.pipeline(transaction=False)
+    for old, _ in moves:
+        pipe.dump(old)
+        pipe.pttl(old)
+    dumped = pipe.execute()
+
+    pipe = redis.pipeline(transaction=False)
+    restored = []
+    for (old, new), value, ttl in zip(moves, dumped[::2], dumped[1::2]):
+        if value is None:
+            continue
+        pipe.restore(new, max(ttl, 0), value)
+        restored.append(old)
+    results = pipe.execute(raise_on_error=False)
+
+    pipe = redis.pipeline(transaction=False)
+    moved = skipped = 0
+    for old, result in zip(restored, results):
+        if isinstance(result, Exception):
+            logger.warning(f'{old} is not moved: {result}')
+            skipped += 1
+        else:
+            pipe.delete(old)
+            moved += 1
+    pipe.execute()
+    return moved, skipped
+
+
+def migrate(redis: StrictRedis, prefix: str = '', reverse: bool = False, dry_run: bool = False,
+            batch: int = 500) -> Tuple[int, int]:
+    moved = skipped = 0
+    moves = []
+    for old, new in all_moves(redis, prefix, reverse, batch):
+        if dry_run:
+            print(f'{old} -> {new}')
+            moved += 1
+            continue
+        moves.append((old, new))
+        if len(moves) >= batch:
+            m, s = move_batch(redis, moves)
+            moved, skipped = moved + m, skipped + s
+            moves = []
+    if moves:
+        m, s = move_batch(redis, moves)
+        moved, skipped = moved + m, skipped + s
+    return moved, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move bot keys to Redis Cluster hash tag layout (or back)')
+    parser.add_argument('redis_url', help='for example redis://127.0.0.1')
+    parser.add_argument('--bot-id', help='bot_id of RedisPersistence')
+    parser.add_argument('--reverse', action='store_true', help='from hash tag layout back to plain one')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be moved')
+    parser.add_argument('--cluster', action='store_true', help='redis_url is a node of Redis Cluster')
+    parser.add_argument('--batch', type=int, default=500, help='keys per SCAN and per pipeline')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    prefix = f'bot_{args.bot_id}:' if args.bot_id else ''
+    redis = connect(args.redis_url, args.cluster)
+    moved, skipped = migrate(redis, prefix, args.reverse, args.dry_run, args.batch)
+    logger.info(f'{"to move" if args.dry_run else "moved"}: {moved}, skipped: {skipped}')
+
+
+if __name__ == '__main__':
+    main()
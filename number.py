@@ -4,6 +4,7 @@
 # Simple Bot to reply to Telegram messages
 # This program is dedicated to the public domain under the CC0 license.
 
+import json
 from os import environ
 from random import randint, normalvariate
 from itertools import chain, permutations
@@ -12,7 +13,12 @@ from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler)
 from telegram.ext.callbackcontext import CallbackContext
 
-from redispersistence import RedisPersistence, RedisDict
+from redispersistence import RedisPersistence, RedisJsonObject
+from redis_util import prepare_obj_for_json
+from redis_pool import create_redis, create_redis_cluster, RedisUnavailable
+from session import RedisSession
+from redisstats import RedisStats
+from profiler import UpdateProfiler
 
 import logging
 
@@ -25,6 +31,18 @@ logger = logging.getLogger(__name__)
 
 CHOOSING, GUESS_NUMBER, MULTI1, MULTI2, MULTI3, TWO_ACTIONS, RANDOM = range(7)
 
+CONVERSATION = 'main'
+
+# check answer and store next question by one atomic Redis script, turns on CACHE_INVALIDATION:
+# without the local cache the session and conversation state are read and written back after the script
+ATOMIC_STEP = bool(environ.get('ATOMIC_STEP'))
+
+# sessions are written by background checkpoint every CHECKPOINT_INTERVAL seconds, not by handlers
+CHECKPOINT_INTERVAL = float(environ.get('CHECKPOINT_INTERVAL') or 0) or None
+
+# user ids allowed to use admin commands (/profile)
+ADMIN_IDS = {int(user_id) for user_id in (environ.get('ADMIN_IDS') or '').split(',') if user_id.strip()}
+
 reply_keyboard = [
     ['guess number', 'multi1'],
     ['multi2', 'two_actions'],
@@ -34,12 +52,32 @@ reply_keyboard = [
 markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
 in_game_markup = ReplyKeyboardMarkup([['Done']], resize_keyboard=True)
 
+# per-user statistics and leaderboards, set in main()
+stats = None
+
+# sampling profiler of updates, set in main()
+profiler = None
+
+
+def save_session(user_data, session):
+    """ заменить сессию пользователя на session
+        Сессия сначала пишется в Redis и только потом меняется в памяти: если Redis недоступен
+        (RedisUnavailable), сессия в памяти остается прежней и пользователь остается на том же вопросе
+        С CHECKPOINT_INTERVAL сессия меняется только в памяти, в Redis ее пишет checkpoint
+    """
+    if isinstance(user_data, RedisJsonObject) and not CHECKPOINT_INTERVAL:
+        serialized_value = json.dumps(prepare_obj_for_json(session))
+        user_data.write(serialized_value)
+        user_data.clear()
+        user_data.update(session)
+        user_data.flushed(serialized_value)
+    else:
+        user_data.clear()
+        user_data.update(session)
+
 
 def start(update: Update, context: CallbackContext):
-    user_data = context.user_data
-    user_data.clear()
-    if isinstance(user_data, RedisDict):
-        user_data.flush()
+    save_session(context.user_data, {})
 
     update.message.reply_text(
         "Hi! My name is number-bot. I offer you to play several useful games!"
@@ -72,11 +110,17 @@ def new_multi1():
     }
 
 
+def wrong_simple(user_data, ans):
+    return f"{ans}? wrong! {user_data['question']} = {user_data['right_answer']}"
+
+
+def key_simple(ans):
+    return ans
+
+
 def test_simple(user_data, ans):
-    right_answer = user_data['right_answer']
-    question = user_data['question']
-    if ans != right_answer:
-        return f"{ans}? wrong! {question} = {right_answer}"
+    if ans != user_data['right_answer']:
+        return wrong_simple(user_data, ans)
     return None
 
 
@@ -111,10 +155,21 @@ def new_multi2():
     }
 
 
+def wrong_multi2(user_data, ans):
+    return f"{ans}? wrong! {user_data['q']} = {user_data['right_answer']}"
+
+
+def key_multi2(ans):
+    """ ответ в том же виде, что и right_answer: '2 x 6; 3 x 4' """
+
+    a = str2tuple(ans)
+    if len(a) % 2:
+        return ''
+    return '; '.join(f'{n} x {m}' for n, m in sorted(tuple(sorted([n, m])) for n, m in zip(a[::2], a[1::2])))
+
+
 def test_multi2(user_data, ans):
-    q = user_data['q']
     r = list(map(tuple, user_data['r']))
-    right_answer = user_data['right_answer']
 
     if not ans.replace(' ', '').isdecimal():
         ans = ''.join([c if c.isdecimal() else ' ' for c in ans])
@@ -124,11 +179,11 @@ def test_multi2(user_data, ans):
 
     a = list(map(int, ans.split(' ')))
     if not len(a) or len(a) % 2:
-        return f"{ans}? wrong! {q} = {right_answer}"
+        return wrong_multi2(user_data, ans)
     else:
         b = sorted([tuple(sorted([n, m])) for n, m in zip(a[::2], a[1::2])])
         if b != r:
-            return f"{ans}? wrong! {q} = {right_answer}"
+            return wrong_multi2(user_data, ans)
 
     return None
 
@@ -166,8 +221,15 @@ def str2tuple(s):
     return tuple(map(int, s.strip().split(' ')))
 
 
+def wrong_multi3(user_data, ans):
+    return f'{ans}? wrong! {user_data["right_answer"]}'
+
+
+def key_multi3(ans):
+    return json.dumps(tuple(map(str2tuple, ans.splitlines())))
+
+
 def test_multi3(user_data, ans):
-    right_answer = user_data['right_answer']
     answers = user_data['answers']
 
     a = tuple(map(str2tuple, ans.splitlines()))
@@ -177,7 +239,7 @@ def test_multi3(user_data, ans):
     else:
         logger.info(answers)
         logger.error(a)
-        return f'{ans}? wrong! {right_answer}'
+        return wrong_multi3(user_data, ans)
 
 
 def new_two_actions():
@@ -280,9 +342,27 @@ def new_two_actions():
         }
 
 
+def record_answer(update: Update, quest_type, correct, counted=False):
+    if stats:
+        user = update.effective_user
+        stats.record(user.id, quest_type, correct, user.first_name, counted)
+
+
+def record_guess(update: Update):
+    """ попытка guess_number: считается отдельно, ответом считается только угаданное число """
+    if stats:
+        stats.count(update.effective_user.id, 'guess_number', 'guesses')
+
+
+def record_asked(update: Update):
+    if stats:
+        stats.asked(update.effective_user.id)
+
+
 def test_answer(update: Update, user_data, quest_type, test_func, rules=None):
     if user_data.get('quest_type', user_data.get('choice')) == quest_type:
         r = test_func(user_data, update.message.text.lower().strip())
+        record_answer(update, quest_type, not r)
         if r:
             update.message.reply_text(r)
     elif rules:
@@ -290,15 +370,54 @@ def test_answer(update: Update, user_data, quest_type, test_func, rules=None):
 
 
 def ask_question(update: Update, user_data, choice_name, new_quest, ret):
-    user_data['choice'] = choice_name
-    user_data.update(new_quest)
-    if isinstance(user_data, RedisDict):
-        user_data.flush()
+    save_session(user_data, {**user_data, 'choice': choice_name, **new_quest, 'answer_keys': answer_keys(new_quest)})
     update.message.reply_text(new_quest['question'])#, reply_markup=in_game_markup)
+    record_asked(update)
+    return ret
+
+
+step_games = {
+        'multi1': (key_simple, wrong_simple),
+        'multi2': (key_multi2, wrong_multi2),
+        'multi3': (key_multi3, wrong_multi3),
+        'two_actions': (key_simple, wrong_simple),
+    }
+
+
+def answer_keys(new_quest):
+    if 'answers' in new_quest:
+        return [json.dumps(a) for a in new_quest['answers']]
+    return [new_quest['right_answer']]
+
+
+def step_question(update: Update, context: CallbackContext, quest_type, rules, choice_name, new_quest, ret):
+    """ проверка ответа и следующий вопрос одним атомарным скриптом в Redis, здесь только ответы пользователю """
+
+    user_data = context.user_data
+    ans = update.message.text.lower().strip()
+    answer_key, wrong_reply = step_games.get(quest_type, (key_simple, wrong_simple))
+    new_session = {**user_data, 'choice': choice_name, **new_quest, 'answer_keys': answer_keys(new_quest)}
+
+    checked, correct, previous = context.dispatcher.persistence.game_step(
+        CONVERSATION, (update.effective_chat.id, update.effective_user.id),
+        update.effective_user.id, user_data,
+        quest_type or '', answer_key(ans), new_session, ret)
+
+    if checked:
+        record_answer(update, quest_type, correct, counted=True)
+    if checked and not correct:
+        update.message.reply_text(wrong_reply(previous, ans))
+    elif not checked and rules:
+        update.message.reply_text(rules)
+    update.message.reply_text(new_quest['question'])
+    record_asked(update)
     return ret
 
 
 def multi1(update: Update, context: CallbackContext):
+    if ATOMIC_STEP:
+        return step_question(update, context, 'multi1', new_multi1.__doc__, 'multi1', new_multi1(), MULTI1)
+
     user_data = context.user_data
     test_answer(update, user_data, 'multi1', test_simple, new_multi1.__doc__)
 
@@ -307,6 +426,9 @@ def multi1(update: Update, context: CallbackContext):
 
 
 def multi2(update: Update, context: CallbackContext):
+    if ATOMIC_STEP:
+        return step_question(update, context, 'multi2', new_multi2.__doc__, 'multi2', new_multi2(), MULTI2)
+
     user_data = context.user_data
     test_answer(update, user_data, 'multi2', test_multi2, new_multi2.__doc__)
 
@@ -315,6 +437,9 @@ def multi2(update: Update, context: CallbackContext):
 
 
 def multi3(update: Update, context: CallbackContext):
+    if ATOMIC_STEP:
+        return step_question(update, context, 'multi3', new_multi3.__doc__, 'multi3', new_multi3(), MULTI3)
+
     user_data = context.user_data
     test_answer(update, user_data, 'multi3', test_multi3, new_multi3.__doc__)
 
@@ -323,6 +448,10 @@ def multi3(update: Update, context: CallbackContext):
 
 
 def two_actions(update: Update, context: CallbackContext):
+    if ATOMIC_STEP:
+        return step_question(update, context, 'two_actions', new_multi3.__doc__, 'two_actions', new_two_actions(),
+                             TWO_ACTIONS)
+
     user_data = context.user_data
     test_answer(update, user_data, 'two_actions', test_simple, new_multi3.__doc__)
 
@@ -342,6 +471,12 @@ def random(update: Update, context: CallbackContext):
     user_data = context.user_data
 
     quest_type = user_data.get('quest_type', user_data.get('choice'))
+    if ATOMIC_STEP:
+        new_type = list(games.keys())[randint(0, len(games)-1)]
+        return step_question(update, context, quest_type if quest_type in games else None,
+                             'Различные примеры на умножение и деление из multi1, multi2, two_actions',
+                             new_type, games[new_type][0](), RANDOM)
+
     if quest_type in games:
         game = games[quest_type]
         test_answer(update, user_data, quest_type, game[1])
@@ -370,9 +505,9 @@ def guess_number(update: Update, context: CallbackContext):
         right_answer = user_data['right_answer']
 
         if ans == right_answer:
-            user_data.clear()
-            if isinstance(user_data, RedisDict):
-                user_data.flush()
+            record_guess(update)
+            record_answer(update, 'guess_number', True)
+            save_session(user_data, {})
             update.message.reply_text(f'Молодец, угадал!\nя загадал {right_answer}')
             return guess_number(update, context)
 
@@ -380,6 +515,7 @@ def guess_number(update: Update, context: CallbackContext):
             update.message.reply_text('В моем числе нет повторяющихся цифр, попробуй снова')#, reply_markup=in_game_markup)
             return GUESS_NUMBER
 
+        record_guess(update)
         a, b = calc_nums(ans, right_answer)
         update.message.reply_text(f'{a}:{b}')#, reply_markup=in_game_markup)
         return GUESS_NUMBER
@@ -390,12 +526,12 @@ def guess_number(update: Update, context: CallbackContext):
         if d not in right_answer:
             right_answer += d
 
-    user_data.update({
+    save_session(user_data, {
+        **user_data,
         'choice': 'guess_number',
         'right_answer': right_answer})
-    if isinstance(user_data, RedisDict):
-        user_data.flush()
 
+    record_asked(update)
     update.message.reply_text("Давай начнем,\nУгадай число что я загадал,\nнапиши число из 4 неповторяющихся цифр, а я подскажу сколько цифр ты угадал, и сколько из них расположил на своем месте.")#, reply_markup=in_game_markup)
     return GUESS_NUMBER
 
@@ -416,25 +552,121 @@ def done(update: Update, context: CallbackContext):
     return start(update, context)
 
 
+def show_stats(update: Update, context: CallbackContext):
+    """Show statistics of the user by games."""
+    user_stats = stats.user_stats(update.effective_user.id)
+    if not user_stats:
+        update.message.reply_text("No statistics yet, let's play!")
+        return
+
+    lines = []
+    for quest_type, c in sorted(user_stats.items()):
+        right, wrong = c.get('right', 0), c.get('wrong', 0)
+        if 'guesses' in c:
+            line = f"{quest_type}: won {right}"
+            if right:
+                line += f", {c['guesses'] / right:.1f} guesses per game"
+        else:
+            line = f"{quest_type}: {right}/{right + wrong}"
+            if right + wrong:
+                line += f" ({round(100 * right / (right + wrong))}%)"
+        line += f", streak {c.get('streak', 0)}, best {c.get('best_streak', 0)}"
+        if c.get('timed'):
+            line += f", avg {c['time_ms'] / c['timed'] / 1000:.1f} s"
+        lines.append(line)
+    update.message.reply_text('\n'.join(lines))
+
+
+def show_top(update: Update, context: CallbackContext):
+    """Show leaderboard: /top [game]"""
+    quest_type = context.args[0] if context.args else RedisStats.ALL
+    top = stats.top(quest_type)
+    if not top:
+        update.message.reply_text(f"No one played {quest_type} yet")
+        return
+
+    lines = [f"{n}. {name} - {score}" for n, (name, score) in enumerate(top, 1)]
+    if quest_type != RedisStats.ALL:
+        streaks = stats.top_streak(quest_type, 3)
+        lines += ['', 'best streaks:'] + [f"{name} - {score}" for name, score in streaks]
+    update.message.reply_text('\n'.join(lines))
+
+
+def profile(update: Update, context: CallbackContext):
+    """Admin: /profile [sample rate, 0..1 | off | dump]"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    arg = context.args[0] if context.args else 'dump'
+    if arg == 'dump':
+        files = profiler.dump()
+        lines = profiler.summary() + files
+        update.message.reply_text('\n'.join(lines) if lines else "Nothing is profiled yet")
+    elif arg == 'off':
+        files = profiler.stop()
+        update.message.reply_text('\n'.join(['Profiling is off'] + files))
+    else:
+        try:
+            profiler.start(float(arg))
+        except ValueError:
+            update.message.reply_text("Usage: /profile [sample rate, 0..1 | off | dump]")
+            return
+        update.message.reply_text(f"Profiling {profiler.sample_rate:.2%} of updates to {profiler.out_dir}")
+
+
 def error(update: Update, context: CallbackContext):
-    """Log Errors caused by Updates."""
+    """Log Errors caused by Updates.
+        While Redis is unavailable the bot is read-only: answers are checked against the session cached in memory
+        (the one read last, also without the local cache), but nothing is saved, the session and conversation state stay as they were, so the user gets the same
+        question again when Redis is back."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
+    if isinstance(context.error, RedisUnavailable) and isinstance(update, Update) and update.effective_message:
+        update.effective_message.reply_text("Sorry, I can't save the game right now, try again in a minute")
 
 
 def main():
     # Create the Updater and pass it your bot's token.
     token = environ.get('TOKEN')
     redis_url = environ.get('REDIS_URL') or 'redis://redis'
-    persistence = RedisPersistence(redis_url, store_chat_data=False, store_bot_data=False)
+    max_connections = int(environ.get('REDIS_MAX_CONNECTIONS') or 50)
+    socket_timeout = float(environ.get('REDIS_TIMEOUT') or 5)
+    cluster = bool(environ.get('REDIS_CLUSTER'))
+    hash_tags = cluster or bool(environ.get('REDIS_HASH_TAGS'))
+    if cluster:
+        redis = create_redis_cluster(redis_url, max_connections=max_connections, socket_timeout=socket_timeout)
+    else:
+        redis = create_redis(redis_url, max_connections=max_connections, socket_timeout=socket_timeout)
+        if environ.get('REDIS_METRICS_INTERVAL'):
+            redis.log_metrics(float(environ.get('REDIS_METRICS_INTERVAL')))
+
+    persistence = RedisPersistence(redis, store_chat_data=False, store_bot_data=False,
+                                   cache_invalidation=ATOMIC_STEP or bool(environ.get('CACHE_INVALIDATION')),
+                                   user_data_class=RedisSession,
+                                   checkpoint_interval=CHECKPOINT_INTERVAL,
+                                   hash_tags=hash_tags,
+                                   warm_file=environ.get('WARM_FILE'))
+
+    global stats
+    stats = RedisStats(redis, hash_tags=hash_tags)
 
     updater = Updater(token, persistence=persistence)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
+    global profiler
+    profiler = UpdateProfiler(dp, out_dir=environ.get('PROFILE_DIR') or 'profile')
+    if environ.get('PROFILE_SAMPLE_RATE'):
+        profiler.start(float(environ.get('PROFILE_SAMPLE_RATE')))
+
+    # statistics commands go before conversation, its states catch any message with digits
+    dp.add_handler(CommandHandler('stats', show_stats))
+    dp.add_handler(CommandHandler('top', show_top))
+    dp.add_handler(CommandHandler('profile', profile))
+
     # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
     conv_handler = ConversationHandler(
-        name='main',
+        name=CONVERSATION,
         persistent=True,
         allow_reentry=True,
         entry_points=[CommandHandler('start', start)],
@@ -469,6 +701,9 @@ def main():
     # log all errors
     dp.add_error_handler(error)
 
+    # prefetch sessions of users active before restart
+    persistence.warm_up()
+
     # Start the Bot
     updater.start_polling()
 
@@ -477,6 +712,10 @@ def main():
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    stats.flush()
+    if profiler.enabled:
+        profiler.stop()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,156 @@
+import os
+import sys
+from collections import defaultdict
+from random import random
+from threading import Lock
+from time import perf_counter_ns
+from typing import Dict, List, Optional
+
+from telegram.ext import Dispatcher
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StackCollector(object):
+    """
+        sys.setprofile callback: wall time (ns) by call stack of one update, C calls included,
+        so Redis socket I/O, json and regex show up as their own frames
+        Handler is the callback called from Handler.handle_update
+    """
+
+    __slots__ = ('stack', 'times', 'handler', 'last')
+
+    def __init__(self):
+        self.stack: List[str] = []
+        self.times: Dict[tuple, int] = defaultdict(int)
+        self.handler: Optional[str] = None
+        self.last = perf_counter_ns()
+
+    def __call__(self, frame, event, arg) -> None:
+        now = perf_counter_ns()
+        self.times[tuple(self.stack)] += now - self.last
+        if event == 'call':
+            module = frame.f_globals.get('__name__') or '?'
+            if self.handler is None and frame.f_back is not None and frame.f_back.f_code.co_name == 'handle_update':
+                callback = getattr(frame.f_back.f_locals.get('self'), 'callback', None)
+                if getattr(callback, '__code__', None) is frame.f_code:
+                    self.handler = frame.f_code.co_name
+            self.stack.append(f'{module}:{frame.f_code.co_name}')
+        elif event == 'c_call':
+            module = getattr(arg, '__module__', None) or 'builtins'
+            self.stack.append(f'{module}:{getattr(arg, "__qualname__", None) or type(arg).__name__}')
+        elif self.stack:
+            self.stack.pop()
+        self.last = perf_counter_ns()
+
+
+class UpdateProfiler(object):
+    """
+        Profiles a sample of updates end to end: Dispatcher.process_update with filters,
+        ConversationHandler, the handler callback, persistence and Redis calls
+        Stacks are aggregated per handler name and written to {out_dir}/{handler}.folded
+        as collapsed stacks in microseconds: flamegraph.pl handler.folded > handler.svg
+
+        process_update of the dispatcher is wrapped only while profiling is on,
+        so there is no overhead when it is off
+    """
+
+    def __init__(self, dispatcher: Dispatcher, out_dir: str = 'profile', dump_every: int = 100):
+        self.dispatcher = dispatcher
+        self.out_dir = out_dir
+        self.dump_every = dump_every
+        self.sample_rate = 0.0
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.stacks: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.updates: Dict[str, int] = defaultdict(int)
+        self.total_ns: Dict[str, int] = defaultdict(int)
+        self.profiled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def start(self, sample_rate: float = 0.01) -> None:
+        """
+        profile sample_rate part of updates (1 - all)
+        """
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if self.enabled:
+            self.dispatcher.process_update = self._process_update
+            logger.info(f'profiling {self.sample_rate:.2%} of updates to {self.out_dir}')
+        else:
+            self.stop()
+
+    def stop(self) -> List[str]:
+        """
+        remove the wrapper, write and clear collected stacks
+        """
+        self.sample_rate = 0.0
+        self.dispatcher.__dict__.pop('process_update', None)
+        files = self.dump()
+        with self._lock:
+            self._reset()
+        return files
+
+    def _process_update(self, update: object) -> None:
+        process_update = type(self.dispatcher).process_update
+        if random() >= self.sample_rate:
+            return process_update(self.dispatcher, update)
+
+        collector = StackCollector()
+        start = perf_counter_ns()
+        sys.setprofile(collector)
+        try:
+            return process_update(self.dispatcher, update)
+        finally:
+            sys.setprofile(None)
+            self._add(collector, perf_counter_ns() - start)
+
+    def _add(self, collector: StackCollector, duration_ns: int) -> None:
+        handler = collector.handler or 'unhandled'
+        with self._lock:
+            stacks = self.stacks[handler]
+            for stack, ns in collector.times.items():
+                if stack:
+                    stacks[';'.join(stack)] += ns
+            self.updates[handler] += 1
+            self.total_ns[handler] += duration_ns
+            self.profiled += 1
+            dump = self.dump_every and self.profiled % self.dump_every == 0
+        if dump:
+            self.dump()
+
+    def summary(self) -> List[str]:
+        """
+        handler: profiled updates and average time (with profiler overhead)
+        """
+        with self._lock:
+            return [f'{handler}: {n} updates, avg {self.total_ns[handler] / n / 1e6:.2f} ms'
+                    for handler, n in sorted(self.updates.items(), key=lambda item: -self.total_ns[item[0]])]
+
+    def dump(self) -> List[str]:
+        """
+        write collapsed stacks, returns written files
+        """
+        with self._lock:
+            stacks = {handler: dict(handler_stacks) for handler, handler_stacks in self.stacks.items()}
+        if not stacks:
+            return []
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        files = []
+        for handler, handler_stacks in stacks.items():
+            path = os.path.join(self.out_dir, f'{handler}.folded')
+            with open(path, 'w') as f:
+                for stack, ns in sorted(handler_stacks.items()):
+                    if ns >= 1000:
+                        f.write(f'{stack} {ns // 1000}\n')
+            files.append(path)
+        for line in self.summary():
+            logger.info(f'profile {line}')
+        return files
@@ -0,0 +1,273 @@
+from random import random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, Optional
+
+from redis import StrictRedis
+from redis.client import Pipeline
+from redis.connection import BlockingConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# commands that are safe to send again when the reply is lost
+IDEMPOTENT_COMMANDS = {
+    'GET', 'MGET', 'SET', 'DEL', 'EXISTS', 'KEYS', 'SCAN', 'TYPE', 'TTL', 'PING', 'PUBLISH',
+    'HGETALL', 'HMGET', 'HSET', 'ZREVRANGE', 'ZSCORE', 'SCRIPT LOAD',
+}
+
+
+class RedisUnavailable(RedisConnectionError):
+    """
+        Redis is down by the circuit breaker, the command was not sent
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+        Open after failure_threshold failed commands in a row: all commands fail fast by RedisUnavailable
+        instead of blocking worker threads. The bot is read-only then: sessions cached locally are read,
+        writes fail and handlers leave the cached sessions as they were (see number.save_session)
+        After reset_timeout commands are sent again, first success closes the breaker, failure opens it again
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        opened_at = self.opened_at
+        return opened_at is not None and monotonic() - opened_at < self.reset_timeout
+
+    def check(self) -> None:
+        if self.is_open:
+            raise RedisUnavailable(f'Redis is unavailable after {self.failures} failures')
+
+    def success(self) -> None:
+        if self.failures:
+            with self._lock:
+                if self.opened_at is not None:
+                    logger.warning('Redis is available again, circuit breaker closed')
+                self.failures = 0
+                self.opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if not self.is_open:
+                    logger.error(f'Redis is unavailable, circuit breaker opened for {self.reset_timeout}s')
+                self.opened_at = monotonic()
+
+
+class MeteredConnectionPool(BlockingConnectionPool):
+    """
+        Blocking pool: worker threads wait for a free connection up to timeout instead of opening new ones,
+        counts time of getting connection from the pool
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = Lock()
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def get_connection(self, command_name, *keys, **options):
+        start = monotonic()
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        finally:
+            wait = monotonic() - start
+            with self._wait_lock:
+                self.waits += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def metrics(self, reset: bool = False) -> Dict[str, float]:
+        with self._wait_lock:
+            metrics = {
+                'max_connections': self.max_connections,
+                'created': len(self._connections),
+                'in_use': self.max_connections - self.pool.qsize(),
+                'waits': self.waits,
+                'wait_avg_ms': round(self.wait_total / self.waits * 1000, 3) if self.waits else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+            if reset:
+                self.waits = 0
+                self.wait_total = 0.0
+                self.wait_max = 0.0
+        return metrics
+
+
+class ResilientPipeline(Pipeline):
+    """
+        Pipeline that fails fast when circuit breaker is open and reports its failures to the breaker
+        Pipelines are not retried: they may hold not idempotent commands
+    """
+
+    def __init__(self, breaker: CircuitBreaker, *args, **kwargs):
+        self.breaker = breaker
+        super().__init__(*args, **kwargs)
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+
+        self.breaker.check()
+        try:
+            result = super().execute(raise_on_error)
+        except (RedisConnectionError, RedisTimeoutError):
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return result
+
+
+class ResilientRedis(StrictRedis):
+    """
+        Redis client with retries of idempotent commands with jittered exponential backoff and circuit breaker
+    """
+
+    def __init__(self, *args, retries: int = 2, backoff: float = 0.05, backoff_cap: float = 1.0,
+                 breaker: Optional[CircuitBreaker] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+
+    def execute_command(self, *args, **options):
+        self.breaker.check()
+        attempts = self.retries + 1 if args[0] in IDEMPOTENT_COMMANDS else 1
+        for attempt in range(attempts):
+            try:
+                result = super().execute_command(*args, **options)
+            except (RedisConnectionError, RedisTimeoutError) as e:
+                if attempt + 1 >= attempts:
+                    self.breaker.failure()
+                    raise
+                delay = random() * min(self.backoff_cap, self.backoff * 2 ** attempt)
+                logger.debug(f'{args[0]} failed: {e}, retry in {delay:.3f}s')
+                sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ResilientPipeline(self.breaker, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def metrics(self, reset: bool = False) -> Dict[str, float]:
+        """
+        pool metrics (connections in use, wait time) and circuit breaker state
+        """
+        metrics = {}
+        if isinstance(self.connection_pool, MeteredConnectionPool):
+            metrics.update(self.connection_pool.metrics(reset))
+        metrics['breaker_open'] = self.breaker.is_open
+        metrics['failures'] = self.breaker.failures
+        return metrics
+
+    def log_metrics(self, interval: float) -> Thread:
+        """
+        log metrics every interval seconds in the background
+        """
+        def run():
+            while True:
+                sleep(interval)
+                logger.info(f'redis pool: {self.metrics(reset=True)}')
+
+        thread = Thread(target=run, name='redis_metrics', daemon=True)
+        thread.start()
+        return thread
+
+
+def create_redis(redis_url: str,
+                 max_connections: int = 50,
+                 pool_timeout: float = 5.0,
+                 socket_connect_timeout: float = 2.0,
+                 socket_timeout: float = 5.0,
+                 health_check_interval: int = 30,
+                 retries: int = 2,
+                 backoff: float = 0.05,
+                 backoff_cap: float = 1.0,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 10.0) -> ResilientRedis:
+    """
+    Redis client with tuned pool, to be shared by RedisPersistence and all stores
+
+    Args:
+        redis_url: url of Redis server, for example redis://127.0.0.1
+        max_connections: pool size
+        pool_timeout: seconds to wait for a free connection of the pool
+        socket_connect_timeout, socket_timeout: seconds to wait for connect and for reply
+        health_check_interval: seconds of idle after that connection is checked by PING before use
+        retries, backoff, backoff_cap: retries of idempotent commands, delay is random up to
+            min(backoff_cap, backoff * 2 ** attempt) seconds
+        failure_threshold, reset_timeout: circuit breaker opens after failure_threshold failures in a row
+            for reset_timeout seconds
+    """
+
+    pool = MeteredConnectionPool.from_url(redis_url,
+                                          max_connections=max_connections,
+                                          timeout=pool_timeout,
+                                          socket_connect_timeout=socket_connect_timeout,
+                                          socket_timeout=socket_timeout,
+                                          health_check_interval=health_check_interval,
+                                          decode_responses=True)
+    return ResilientRedis(connection_pool=pool, retries=retries, backoff=backoff, backoff_cap=backoff_cap,
+                          breaker=CircuitBreaker(failure_threshold, reset_timeout))
+
+
+def create_redis_cluster(redis_url: str,
+                         max_connections: int = 50,
+                         socket_connect_timeout: float = 2.0,
+                         socket_timeout: float = 5.0) -> StrictRedis:
+    """
+    Redis Cluster client (needs redis-py-cluster package), use it with hash_tags=True of
+    RedisPersistence and RedisStats, so keys of one user are in one slot
+    The cluster client follows MOVED/ASK redirections and failover by itself
+    """
+
+    try:
+        from rediscluster import RedisCluster
+    except ImportError:
+        raise ImportError('Redis Cluster needs redis-py-cluster: pip install redis-py-cluster')
+
+    return RedisCluster.from_url(redis_url,
+                                 max_connections=max_connections,
+                                 socket_connect_timeout=socket_connect_timeout,
+                                 socket_timeout=socket_timeout,
+                                 skip_full_coverage_check=True,
+                                 decode_responses=True)
+
+
+def is_cluster(redis: StrictRedis) -> bool:
+    """
+    client (or pipeline) of redis-py-cluster, its pipeline doesn't allow PUBLISH and EVALSHA
+    """
+    return type(redis).__module__.startswith('rediscluster')
+
+
+_shared: Dict[str, ResilientRedis] = {}
+_shared_lock = Lock()
+
+
+def shared_redis(redis_url: str) -> ResilientRedis:
+    """
+    one client (and pool) with default settings per url
+    """
+    with _shared_lock:
+        client = _shared.get(redis_url)
+        if client is None:
+            client = _shared[redis_url] = create_redis(redis_url)
+        return client
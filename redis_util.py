@@ -1,7 +1,14 @@
 import json
+import re
+from itertools import count
+from threading import Lock, Thread, Event
+from time import monotonic
+from uuid import uuid4
 from redis import StrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from redis_pool import shared_redis, is_cluster
 from collections import defaultdict
-from typing import Optional, Union, Iterable, List
+from typing import Optional, Union, Iterable, List, Dict, Type
 import logging
 
 logger = logging.getLogger(__name__)
@@ -42,53 +49,274 @@ def prepare_obj_for_json(obj: any) -> Optional[Union[int, float, bool, str, dict
 
 def redis_from_url_or_object(redis_url: Union[str, 'StrictRedis']) -> StrictRedis:
     """
-    return redis object if url passed
+    return redis object if url passed, objects for the same url share one connection pool
     """
 
     if isinstance(redis_url, StrictRedis):
         return redis_url
     elif isinstance(redis_url, str):
-        return StrictRedis.from_url(redis_url, decode_responses=True)
+        return shared_redis(redis_url)
     else:
         assert False, f'redis_url must be Redis object or url, not {type(redis_url)}'
 
 
-class RedisDict(dict):
+class CacheInvalidator(object):
+    """
+        Keep local caches of stores consistent between several bot processes (nodes)
+        Every write of the registered store or dict is published to the channel in the same pipeline
+        (in Redis Cluster right after it, see :meth:`execute`),
+        other nodes drop changed key from their caches (or re-read the dict), so next access read it from Redis
+        Call :meth:`start` to begin listening of the channel
+        Messages published while the channel is lost are not delivered: the listener resubscribes with
+        exponential backoff and drops whole local caches of registered objects on every subscribe
+        (dirty values of :class:`RedisDictStore` stay pinned)
+    """
+
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], channel: str,
+                 backoff: float = 0.5, backoff_cap: float = 30.0):
+        self._redis = redis_from_url_or_object(redis_url)
+        self.channel = channel
+        self.node_id = uuid4().hex
+        self.cluster = is_cluster(self._redis)
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.subscribes = 0
+        self._objects: Dict[str, Union['BaseRedisStore', 'RedisDict']] = {}
+        self._published: Dict[int, List[str]] = {}
+        self._thread = None
+        self._stop = Event()
+        self._subscribed = Event()
+
+    def register(self, obj: Union['BaseRedisStore', 'RedisDict']) -> None:
+        self._objects[obj.key_id] = obj
+
+    def publish(self, key_id: str, pipe) -> None:
+        if self.cluster:
+            # PUBLISH is not allowed in cluster pipeline, it's sent by :meth:`execute` after the write
+            self._published.setdefault(id(pipe), []).append(key_id)
+        else:
+            pipe.publish(self.channel, f'{self.node_id} {key_id}')
+
+    def execute(self, pipe) -> list:
+        """
+        execute pipe with writes of :meth:`set` and :meth:`delete`, in Redis Cluster publish them after it
+        """
+        try:
+            result = pipe.execute()
+        finally:
+            published = self._published.pop(id(pipe), ())
+        for key_id in published:
+            self._redis.publish(self.channel, f'{self.node_id} {key_id}')
+        return result
+
+    def set(self, key_id: str, serialized_value: str, pipe=None) -> None:
+        """
+        set and publish, by pipe if passed (it's executed by the caller with :meth:`execute`)
+        """
+        execute = pipe is None
+        if execute:
+            pipe = self._redis.pipeline(transaction=False)
+        pipe.set(key_id, serialized_value)
+        self.publish(key_id, pipe)
+        if execute:
+            self.execute(pipe)
+
+    def delete(self, key_id: str, pipe=None) -> None:
+        """
+        delete and publish, by pipe if passed (it's executed by the caller with :meth:`execute`)
+        """
+        execute = pipe is None
+        if execute:
+            pipe = self._redis.pipeline(transaction=False)
+        pipe.delete(key_id)
+        self.publish(key_id, pipe)
+        if execute:
+            self.execute(pipe)
+
+    def invalidate(self, key_id: str) -> None:
+        obj = self._objects.get(key_id)
+        if obj is None:
+            obj = self._objects.get(key_id[:key_id.rfind(':')])
+        if obj is None:
+            for obj_key_id, store in self._objects.items():
+                if key_id.startswith(f'{obj_key_id}:'):
+                    obj = store
+                    break
+        if obj is not None:
+            logger.debug(f'invalidate {key_id}')
+            obj.invalidate(key_id)
+
+    def _handle(self, message: dict) -> None:
+        node_id, key_id = message['data'].split(' ', 1)
+        if node_id != self.node_id:
+            self.invalidate(key_id)
+
+    def invalidate_all(self) -> None:
+        for obj in list(self._objects.values()):
+            obj.invalidate_all()
+
+    def start(self, timeout: float = 5.0) -> None:
+        """
+        start listening in the background thread, wait up to timeout seconds for the subscription
+        """
+        self._stop.clear()
+        self._subscribed.clear()
+        self._thread = Thread(target=self._listen, name='redis_invalidator', daemon=True)
+        self._thread.start()
+        if not self._subscribed.wait(timeout):
+            logger.warning(f'not subscribed to {self.channel} yet, local caches may be stale until it is')
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _listen(self) -> None:
+        delay = self.backoff
+        while not self._stop.is_set():
+            pubsub = self._redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if message is None:
+                        continue
+                    if message['type'] == 'subscribe':
+                        # changes published while not subscribed are lost
+                        self.invalidate_all()
+                        self.subscribes += 1
+                        self._subscribed.set()
+                        delay = self.backoff
+                    elif message['type'] == 'message':
+                        self._handle(message)
+            except Exception as e:
+                logger.warning(f'{self.channel} listener failed: {e}, resubscribe in {delay:.1f}s')
+                self._stop.wait(delay)
+                delay = min(self.backoff_cap, delay * 2)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+class RedisJsonObject(object):
+    """
+        Mixin for mapping, that store in Redis as one solid json by his own redis key (key_id)
+        Subclass must set attributes _redis, key_id, _serialized and _invalidator
+    """
+
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def read(self):
+        self.load(self._redis.get(self.key_id) or '{}')
+
+    def load(self, serialized_value: str):
+        """
+        replace content by json already stored in Redis, without writing it back
+        """
+        self.clear()
+        self.update(json.loads(serialized_value))
+        self._serialized = serialized_value
+
+    def dump(self) -> Optional[str]:
+        """
+        json of the object, None if it's the same as stored in Redis
+        Unchanged object is skipped only with invalidator: without it the object may be stale
+        (changed by another node), so it's always written and the last writer wins
+        """
+        obj = prepare_obj_for_json(self.to_dict())
+        serialized_value = json.dumps(obj)
+        if serialized_value == self._serialized and self._invalidator is not None:
+            return None
+        return serialized_value
+
+    def changed(self) -> bool:
+        """
+        content differs from json last read from or written to Redis by this node (order of keys doesn't matter)
+        """
+        if self._serialized is None:
+            return True
+        return prepare_obj_for_json(self.to_dict()) != json.loads(self._serialized)
+
+    def write(self, serialized_value: str, pipe=None) -> None:
+        """
+        write json to Redis, by pipe if passed, call :meth:`flushed` when it's executed
+        """
+        client = self._redis if pipe is None else pipe
+        if self._invalidator is None:
+            client.set(self.key_id, serialized_value)
+        else:
+            self._invalidator.set(self.key_id, serialized_value, pipe)
+
+    def flushed(self, serialized_value: str) -> None:
+        self._serialized = serialized_value
+
+    def flush(self):
+        serialized_value = self.dump()
+        if serialized_value is None:
+            return
+        self.write(serialized_value)
+        self.flushed(serialized_value)
+
+    def invalidate(self, key_id: str) -> None:
+        self.read()
+
+    def invalidate_all(self) -> None:
+        self.read()
+
+
+class RedisDict(RedisJsonObject, dict):
     """
         Dictionary, that store in Redis as one solid json by his own redis key (key_id)
         for save dict in redis it's need to call :meth:`telegram.ext.redis_util.RedisDict.flush`
         read object from redis on initialization :meth:`telegram.ext.redis_util.RedisDict.__init__`
     """
 
-    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, seq: Optional[Iterable] = None, **kwargs):
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, seq: Optional[Iterable] = None,
+                 invalidator: Optional[CacheInvalidator] = None, **kwargs):
         self._redis = redis_from_url_or_object(redis_url)
         self.key_id = key_id
+        self._serialized = None
+        self._invalidator = invalidator
         args = [] if seq is None else [seq]
         super().__init__(*args, **kwargs)
         if not self:
             self.read()
 
-    def read(self):
-        self.clear()
-        self.update(json.loads(self._redis.get(self.key_id) or '{}'))
+    def to_dict(self) -> dict:
+        return self
 
-    def flush(self):
-        obj = prepare_obj_for_json(self)
-        self._redis.set(self.key_id, json.dumps(obj))
+
+def hash_tag(value: any) -> str:
+    """
+    Redis Cluster hash tag: keys with the same tag are in the same slot
+    """
+    return f'{{{value}}}'
 
 
 class BaseRedisStore(defaultdict):
     """
         Dictionary that store values in Redis, every by his own key as key_id:key
+        (key_id:{key} with hash_tags, so all keys of one user share the cluster slot)
         It's using 'lazy read' from Redis, so read key value only when key is requested
         All keys convert to str
     """
 
     def key2id(self, key: any) -> str:
+        if self.hash_tags:
+            return f"{self.key_id}:{hash_tag(key)}"
         return f"{self.key_id}:{key}"
 
     def id2key(self, key_id: str) -> str:
-        return key_id[len(self.key_id) + 1:]
+        key = key_id[len(self.key_id) + 1:]
+        if self.hash_tags and key.startswith('{') and key.endswith('}'):
+            key = key[1:-1]
+        return key
 
     @staticmethod
     def serialize(key: any, value: any) -> str:
@@ -108,11 +336,17 @@ class BaseRedisStore(defaultdict):
 
     def __save_to_redis__(self, key: any, value: any) -> any:
         serialized_value = self.serialize(key, value)
-        self._redis.set(self.key2id(key), serialized_value)
+        if self._invalidator is None:
+            self._redis.set(self.key2id(key), serialized_value)
+        else:
+            self._invalidator.set(self.key2id(key), serialized_value)
         return value
 
     def __remove_from_redis__(self, key: any) -> None:
-        self._redis.delete(self.key2id(key))
+        if self._invalidator is None:
+            self._redis.delete(self.key2id(key))
+        else:
+            self._invalidator.delete(self.key2id(key))
 
     def __exists_in_redis__(self, key: any) -> bool:
         logger.debug(f'check {key} in redis')
@@ -121,8 +355,12 @@ class BaseRedisStore(defaultdict):
     def __read_keys_from_redis__(self) -> List[any]:
         return [self.id2key(key_id) for key_id in self._redis.keys(f'{self.key_id}:*')]
 
+    def __value_from_redis__(self, key: any, serialized_value: str) -> any:
+        return self.deserialize(key, serialized_value)
+
     def __read_throw_redis__(self, key: any) -> any:
         key = str(key)
+        self.misses += 1
         value = self.__read_from_redis__(key)
         if value is not value_not_exists:
             super().__setitem__(key, value)
@@ -140,9 +378,59 @@ class BaseRedisStore(defaultdict):
     def free(self, key: any) -> None:
         super().__delitem__(key)
 
-    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=None, lazy_read=True, seq=None):
+    def cache(self, key: any, value: any) -> None:
+        """
+        put value, that is already stored in Redis, to the local cache only
+        """
+        super().__setitem__(str(key), value)
+
+    def invalidate(self, key_id: str) -> None:
+        """
+        drop key changed by another node from the local cache
+        """
+        super().pop(str(self.id2key(key_id)), None)
+
+    def invalidate_all(self) -> None:
+        """
+        drop the whole local cache, changes of other nodes may be missed
+        """
+        dict.clear(self)
+
+    def prefetch(self, keys: Iterable, batch_size: int = 500) -> int:
+        """
+        read values of keys, that are not cached yet, to the local cache by pipelined batches
+        return count of found values
+        """
+        keys = [key for key in map(str, keys) if not dict.__contains__(self, key)]
+        found = 0
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            pipe = self._redis.pipeline(transaction=False)
+            for key in batch:
+                pipe.get(self.key2id(key))
+            for key, serialized_value in zip(batch, pipe.execute()):
+                if serialized_value is None:
+                    continue
+                value = self.__value_from_redis__(key, serialized_value)
+                if value is not value_not_exists:
+                    self.cache(key, value)
+                    found += 1
+        return found
+
+    def cache_info(self) -> Dict[str, int]:
+        """
+        lookups of keys, misses (read from Redis) and size of the local cache
+        """
+        return {'lookups': self.lookups, 'misses': self.misses, 'cached': len(self.keys())}
+
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=None, lazy_read=True, seq=None,
+                 invalidator: Optional[CacheInvalidator] = None, hash_tags: bool = False):
         self.key_id = key_id
         self._redis = redis_from_url_or_object(redis_url)
+        self._invalidator = invalidator
+        self.hash_tags = hash_tags
+        self.lookups = 0
+        self.misses = 0
 
         args = []
         if seq is not None:
@@ -157,6 +445,7 @@ class BaseRedisStore(defaultdict):
         if key in self:
             return self[key]
 
+        self.lookups += 1
         value = self.__read_throw_redis__(key)
         if value is not value_not_exists:
             return value
@@ -168,6 +457,7 @@ class BaseRedisStore(defaultdict):
         if key in self:
             return self[key]
 
+        self.lookups += 1
         value = self.__read_throw_redis__(key)
         if value is not value_not_exists:
             return value
@@ -183,6 +473,10 @@ class BaseRedisStore(defaultdict):
 
         return self.__save_throw_redis__(key, self.default_factory())
 
+    def __getitem__(self, key: any) -> any:
+        self.lookups += 1
+        return super().__getitem__(str(key))
+
     def __setitem__(self, key: any, value: any) -> None:
         self.__save_throw_redis__(key, value)
 
@@ -194,36 +488,151 @@ class BaseRedisStore(defaultdict):
         return iter(self.keys() | self.__read_keys_from_redis__())
 
     def __copy__(self):
-        return self.__class__(self._redis, self.key_id, default_factory=self.default_factory, seq=self.items())
+        copy = self.__class__(self._redis, self.key_id, default_factory=self.default_factory, seq=self.items(),
+                              invalidator=self._invalidator, hash_tags=self.hash_tags)
+        copy.__dict__.update(self.__dict__)
+        return copy
 
 
 class RedisDictStore(BaseRedisStore):
     """
         Dictionary that store many dicts, every by his own key in Redis
-        Every dict is RedisDict - dict that store as solid json
+        Every dict is RedisDict (or other dict_class) - dict that store as solid json
         It's using 'lazy read' from BaseRedisStore
+        Dicts are kept in the local cache only with local_cache (by default when invalidator is passed),
+        otherwise every access reads the dict from Redis again: another node may have changed it
+        (if Redis is unavailable, the dict read last time is returned)
+        Dirty dicts (see :meth:`mark_dirty`) are pinned until :meth:`checkpoint` writes them:
+        invalidation doesn't drop them and reading the key returns the pinned dict
+        (:meth:`invalidate_all` clears the cache, pinned dicts are read back from it)
     """
 
-    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=lambda: dict(), lazy_read=True, seq=None):
-        super().__init__(redis_url, key_id, default_factory=default_factory, lazy_read=lazy_read, seq=seq)
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=lambda: dict(), lazy_read=True, seq=None,
+                 invalidator: Optional[CacheInvalidator] = None, dict_class: Type[RedisJsonObject] = RedisDict,
+                 hash_tags: bool = False, local_cache: Optional[bool] = None):
+        self.dict_class = dict_class
+        self.local_cache = invalidator is not None if local_cache is None else local_cache
+        self._dirty: Dict[str, tuple] = {}
+        self._dirty_lock = Lock()
+        self._marks = count()
+        super().__init__(redis_url, key_id, default_factory=default_factory, lazy_read=lazy_read, seq=seq,
+                         invalidator=invalidator, hash_tags=hash_tags)
 
     def __read_from_redis__(self, key: any) -> any:
         if self.__exists_in_redis__(key):
-            return RedisDict(self._redis, self.key2id(key))
+            return self.dict_class(self._redis, self.key2id(key), invalidator=self._invalidator)
         else:
             return value_not_exists
 
-    def __save_to_redis__(self, key: any, value: dict) -> RedisDict:
-        if not isinstance(value, RedisDict):
+    def __read_throw_redis__(self, key: any) -> any:
+        dirty = self._dirty.get(str(key))
+        if dirty is not None:
+            dict.__setitem__(self, str(key), dirty[0])
+            return dirty[0]
+        return super().__read_throw_redis__(key)
+
+    def __getitem__(self, key: any) -> any:
+        if self.local_cache:
+            return super().__getitem__(key)
+        last_read = dict.pop(self, str(key), None)
+        try:
+            return super().__getitem__(key)
+        except (RedisConnectionError, RedisTimeoutError):
+            if last_read is None:
+                raise
+            # read-only while Redis is unavailable: the dict read last time, writes still fail
+            dict.__setitem__(self, str(key), last_read)
+            return last_read
+
+    def invalidate(self, key_id: str) -> None:
+        if str(self.id2key(key_id)) in self._dirty:
+            # not written yet, it will overwrite the change of another node
+            return
+        super().invalidate(key_id)
+
+    def __value_from_redis__(self, key: any, serialized_value: str) -> any:
+        value = json.loads(serialized_value)
+        if not value:
+            # empty dict_class reads itself from Redis, leave it to the lazy read
+            return value_not_exists
+        value = self.dict_class(self._redis, self.key2id(key), value, invalidator=self._invalidator)
+        value.flushed(serialized_value)
+        return value
+
+    def __save_to_redis__(self, key: any, value: dict) -> RedisJsonObject:
+        if not isinstance(value, RedisJsonObject):
             assert isinstance(value, dict), f'item value of RedisDictStore must be a dict, not {type(value)}'
-            value = RedisDict(self._redis, self.key2id(key), value.items())
+            value = self.dict_class(self._redis, self.key2id(key), value.items(), invalidator=self._invalidator)
         value.flush()
         return value
 
     def flush(self) -> None:
+        if not self.local_cache:
+            # values are written on update, the ones left are stale reads
+            return
         for value in self.values():
             value.flush()
 
+    def mark_dirty(self, key: any, value: Optional[RedisJsonObject] = None) -> None:
+        """
+        value of the key (the cached one if not passed) is changed and will be written by the next :meth:`checkpoint`
+        Value that isn't changed since it was read or written is not marked: the local cache is authoritative
+        with checkpoints, so e.g. update of all cached values before the final flush writes only changed ones
+        """
+        key = str(key)
+        if value is None:
+            value = dict.get(self, key)
+        if value is None or not value.changed():
+            return
+        with self._dirty_lock:
+            self._dirty[key] = (value, next(self._marks))
+
+    @property
+    def backlog(self) -> int:
+        return len(self._dirty)
+
+    def _clean(self, key: str, mark: int) -> None:
+        # marked again during the write: keep it for the next checkpoint
+        with self._dirty_lock:
+            if self._dirty.get(key, (None, None))[1] == mark:
+                del self._dirty[key]
+
+    def checkpoint(self, budget: Optional[float] = None, batch_size: int = 500) -> int:
+        """
+        write dirty values by pipelined batches, until time budget (in seconds) is spent
+        value is dirty until its write is executed, failed batch stays dirty
+        return count of written values
+        """
+        deadline = None if budget is None else monotonic() + budget
+        dirty = list(self._dirty.items())
+        written = 0
+        while dirty and (deadline is None or monotonic() < deadline):
+            pipe = self._redis.pipeline(transaction=False)
+            batch = []
+            while dirty and len(batch) < batch_size:
+                key, (value, mark) = dirty.pop()
+                try:
+                    serialized_value = value.dump()
+                except RuntimeError:
+                    # changed by handler during serialization, it's left for the next checkpoint
+                    continue
+                if serialized_value is None:
+                    self._clean(key, mark)
+                    continue
+                value.write(serialized_value, pipe)
+                batch.append((key, value, mark, serialized_value))
+
+            if batch:
+                if self._invalidator is None:
+                    pipe.execute()
+                else:
+                    self._invalidator.execute(pipe)
+            for key, value, mark, serialized_value in batch:
+                value.flushed(serialized_value)
+                self._clean(key, mark)
+            written += len(batch)
+        return written
+
 
 class RedisSimpleStore(BaseRedisStore):
     """
@@ -232,16 +641,36 @@ class RedisSimpleStore(BaseRedisStore):
         Don't use 'lazy read' by default, immediate read all keys from Redis on initialization
         keys converting to json, so it suitable for use tuple as keys,
         tuple encoding to list when storing and decoding to tuple when reading
+        with hash_tags key is key_id:{tag}:json, tag is the last id of the key (user of the conversation)
+        With invalidator setting the same value as cached is not written
     """
 
+    @staticmethod
+    def key_tag(key: any) -> str:
+        ids = re.findall(r'-?\d+', str(key))
+        return ids[-1] if ids else str(key)
+
     def key2id(self, key: any) -> str:
+        if self.hash_tags:
+            return f"{self.key_id}:{hash_tag(self.key_tag(key))}:{json.dumps(key)}"
         return f"{self.key_id}:{json.dumps(key)}"
 
     def id2key(self, key_id: str) -> any:
-        key = json.loads(key_id[len(self.key_id) + 1:])
+        serialized_key = key_id[len(self.key_id) + 1:]
+        if self.hash_tags and serialized_key.startswith('{'):
+            serialized_key = serialized_key[serialized_key.index('}') + 2:]
+        key = json.loads(serialized_key)
         if isinstance(key, list):
             key = tuple(key)
         return key
 
-    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=lambda: 0, lazy_read=True, seq=None):
-        super().__init__(redis_url, key_id, default_factory=default_factory, lazy_read=lazy_read, seq=seq)
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, default_factory=lambda: 0, lazy_read=True, seq=None,
+                 invalidator: Optional[CacheInvalidator] = None, hash_tags: bool = False):
+        super().__init__(redis_url, key_id, default_factory=default_factory, lazy_read=lazy_read, seq=seq,
+                         invalidator=invalidator, hash_tags=hash_tags)
+
+    def __setitem__(self, key: any, value: any) -> None:
+        key = str(key)
+        if self._invalidator is not None and key in self and dict.__getitem__(self, key) == value:
+            return
+        super().__setitem__(key, value)
@@ -1,7 +1,13 @@
-from typing import DefaultDict, Dict, Any, Tuple, Optional, Union
+import json
+import os
+from collections import OrderedDict
+from threading import Thread, Event, Timer
+from time import monotonic, time
+from typing import DefaultDict, Dict, Any, Tuple, Optional, Union, Type
 
 from telegram.ext.basepersistence import BasePersistence
-from redis_util import RedisDictStore, RedisSimpleStore, RedisDict, redis_from_url_or_object, StrictRedis
+from redis_util import (BaseRedisStore, RedisDictStore, RedisSimpleStore, RedisDict, RedisJsonObject, CacheInvalidator,
+                        redis_from_url_or_object, prepare_obj_for_json, hash_tag, StrictRedis)
 from telegram.utils.types import ConversationDict
 
 import logging
@@ -9,6 +15,46 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# KEYS: user session, conversation state, user stats hash (see redisstats.RedisStats),
+#       all in one cluster slot with hash_tags
+# ARGV: expected quest_type, answer key, new session json, new conversation state json,
+#       invalidation channel and node id (empty channel when cache invalidation is off)
+# Session without answer_keys (asked before ATOMIC_STEP was on) is checked by keys made from answers
+# like number.answer_keys does (json.dumps of lists of numbers: ', ' separator), or by right_answer
+# fakeredis has no cjson, the script is checked on real Redis by check_game_step.py
+GAME_STEP_SCRIPT = """
+local previous = redis.call('GET', KEYS[1]) or '{}'
+local session = cjson.decode(previous)
+local checked = 0
+local correct = 0
+if (session['quest_type'] or session['choice']) == ARGV[1] then
+    checked = 1
+    local answer_keys = session['answer_keys']
+    if not answer_keys and session['answers'] then
+        answer_keys = {}
+        for i, answer in ipairs(session['answers']) do
+            answer_keys[i] = (string.gsub(cjson.encode(answer), ',', ', '))
+        end
+    end
+    answer_keys = answer_keys or {session['right_answer']}
+    for _, answer_key in ipairs(answer_keys) do
+        if answer_key == ARGV[2] then
+            correct = 1
+            break
+        end
+    end
+    redis.call('HINCRBY', KEYS[3], ARGV[1] .. (correct == 1 and ':right' or ':wrong'), 1)
+end
+redis.call('SET', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[2], ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('PUBLISH', ARGV[5], ARGV[6] .. ' ' .. KEYS[1])
+    redis.call('PUBLISH', ARGV[5], ARGV[6] .. ' ' .. KEYS[2])
+end
+return {checked, correct, previous}
+"""
+
+
 class RedisPersistence(BasePersistence):
     """Using Redis for making your bot persistent.
 
@@ -42,6 +88,34 @@ class RedisPersistence(BasePersistence):
                 persistence class. Default is :obj:`True`.
             store_bot_data (:obj:`bool`, optional): Whether bot_data should be saved by this
                 persistence class. Default is :obj:`True` .
+            cache_invalidation (:obj:`bool`, optional): Whether to publish every write to the
+                ``{bot_id}:invalidate`` channel and drop entries changed by other bot processes from the local
+                cache. Without it user_data and chat_data are not cached: they are read from Redis on every
+                access, unless ``checkpoint_interval`` is set, which needs the local cache. So deployments with
+                several replicas sharing one Redis must set it with ``checkpoint_interval``, and should set it
+                anyway to avoid the reads. Default is :obj:`False`.
+            user_data_class (:obj:`type`, optional): Class of every user_data value, :class:`RedisDict` or
+                other :class:`redis_util.RedisJsonObject` (for example :class:`session.RedisSession`).
+                Default is :class:`RedisDict`.
+            checkpoint_interval (:obj:`float`, optional): If set, changed user_data and chat_data are only marked
+                dirty on update and written by background checkpoint every ``checkpoint_interval`` seconds,
+                so :meth:`flush` writes only the remaining dirty set. Default is :obj:`None` - write on update.
+            checkpoint_budget (:obj:`float`, optional): Time limit in seconds of one background checkpoint,
+                the rest stays in the backlog for the next one. Default is ``0.5``.
+            hash_tags (:obj:`bool`, optional): Whether to use Redis Cluster hash tags in keys:
+                ``user_data:{uid}``, ``chat_data:{cid}``, ``conversations:name:{uid}:"(cid, uid)"``, so
+                session, conversation state and stats of one user are in one slot. Use ``migrate_keys.py`` for
+                data stored without them. Default is :obj:`False`.
+            warm_file (:obj:`str`, optional): Local file for warm restart: :meth:`flush` writes there ids of
+                recently active users and conversations, :meth:`warm_up` prefetches them on the next start.
+                Only ids are saved, values are read from Redis. user_data is prefetched only when it's cached
+                locally (see ``cache_invalidation``). A user is active when a conversation state of the user
+                is updated (the last id of the key, as for ``hash_tags``): the dispatcher updates
+                user_data of all cached users on shutdown. Default is :obj:`None` - no warm restart.
+            warm_size (:obj:`int`, optional): How many recently active users (and conversations) are saved.
+                Default is ``10000``.
+            warm_report_after (:obj:`float`, optional): Seconds after :meth:`warm_up` to log cache hit ratio of
+                user_data and conversations. Default is ``300``.
         """
 
     def __init__(self,
@@ -49,17 +123,70 @@ class RedisPersistence(BasePersistence):
                  bot_id: Optional[str] = None,
                  store_user_data: bool = True,
                  store_chat_data: bool = True,
-                 store_bot_data: bool = True):
+                 store_bot_data: bool = True,
+                 cache_invalidation: bool = False,
+                 user_data_class: Type[RedisJsonObject] = RedisDict,
+                 checkpoint_interval: Optional[float] = None,
+                 checkpoint_budget: float = 0.5,
+                 hash_tags: bool = False,
+                 warm_file: Optional[str] = None,
+                 warm_size: int = 10000,
+                 warm_report_after: float = 300):
         super().__init__(store_user_data=store_user_data,
                          store_chat_data=store_chat_data,
                          store_bot_data=store_bot_data)
         self.id_prefix = f'bot_{bot_id}:' if bot_id else ''
+        self.hash_tags = hash_tags
         self._redis = redis_from_url_or_object(redis_url)
-        self._bot_data = RedisDict(self._redis, f'{self.id_prefix}bot_data')
-        self._user_data = RedisDictStore(self._redis, f'{self.id_prefix}user_data')
-        self._chat_data = RedisDictStore(self._redis, f'{self.id_prefix}chat_data')
+        self._invalidator = None
+        if cache_invalidation:
+            self._invalidator = CacheInvalidator(self._redis, f'{self.id_prefix}invalidate')
+
+        self._bot_data = RedisDict(self._redis, f'{self.id_prefix}bot_data', invalidator=self._invalidator)
+        local_cache = cache_invalidation or bool(checkpoint_interval)
+        self._user_data = RedisDictStore(self._redis, f'{self.id_prefix}user_data', invalidator=self._invalidator,
+                                         dict_class=user_data_class, hash_tags=hash_tags, local_cache=local_cache)
+        self._chat_data = RedisDictStore(self._redis, f'{self.id_prefix}chat_data', invalidator=self._invalidator,
+                                         hash_tags=hash_tags, local_cache=local_cache)
 
         self._conversations = dict()
+        self._game_step = self._redis.register_script(GAME_STEP_SCRIPT)
+
+        if self._invalidator:
+            for obj in (self._bot_data, self._user_data, self._chat_data):
+                self._invalidator.register(obj)
+            self._invalidator.start()
+
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_budget = checkpoint_budget
+        self.checkpoint_duration = 0.0
+        self.checkpoint_backlog = 0
+        self._checkpoint_thread = None
+        self._checkpoint_stop = Event()
+        if checkpoint_interval:
+            self._checkpoint_thread = Thread(target=self._checkpoint_loop, name='redis_checkpoint', daemon=True)
+            self._checkpoint_thread.start()
+
+        self.warm_file = warm_file
+        self.warm_size = warm_size
+        self.warm_report_after = warm_report_after
+        self._active_users = OrderedDict()
+        self._active_conversations = OrderedDict()
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        """Stores and their dicts are saved as json, so can't hold :class:`telegram.Bot`. They are returned as is,
+            without copy, so the flushed object is the cached one.
+            """
+        if isinstance(obj, (BaseRedisStore, RedisJsonObject)):
+            return obj
+        return super().replace_bot(obj)
+
+    def insert_bot(self, obj: object) -> object:
+        """Stores are returned as is, so the dispatcher uses the same cached objects as this persistence."""
+        if isinstance(obj, (BaseRedisStore, RedisJsonObject)):
+            return obj
+        return super().insert_bot(obj)
 
     @property
     def user_data(self) -> Optional[DefaultDict[int, Dict]]:
@@ -93,8 +220,11 @@ class RedisPersistence(BasePersistence):
     def get_conversations(self, name: str) -> ConversationDict:
         conversation = self.conversations.get(name, None)
         if conversation is None:
-            conversation = RedisSimpleStore(redis_url=self._redis, key_id=f'{self.id_prefix}conversations:{name}')
+            conversation = RedisSimpleStore(redis_url=self._redis, key_id=f'{self.id_prefix}conversations:{name}',
+                                            invalidator=self._invalidator, hash_tags=self.hash_tags)
             self.conversations[name] = conversation
+            if self._invalidator:
+                self._invalidator.register(conversation)
 
         return conversation
 
@@ -110,6 +240,52 @@ class RedisPersistence(BasePersistence):
             """
         conversation = self.get_conversations(name)
         conversation[key] = new_state
+        self._touch(self._active_conversations, (name, str(key)))
+        self._touch(self._active_users, RedisSimpleStore.key_tag(key))
+
+    def stats_key(self, user_id: int) -> str:
+        """:obj:`str`: Key of the user stats hash, the same as :meth:`redisstats.RedisStats.user_key`."""
+        return f'{self.id_prefix}stats:{hash_tag(user_id) if self.hash_tags else user_id}'
+
+    def game_step(self,
+                  name: str, key: Tuple[int, ...],
+                  user_id: int, user_data: RedisJsonObject,
+                  quest_type: str, answer_key: str,
+                  new_session: Dict, new_state: object) -> Tuple[bool, bool, Dict]:
+        """Will check the answer, record the result, store the next question and set the new conversation state
+            in one atomic Lua script, without any check on the python side.
+            Use it with ``cache_invalidation``: then the session and the state are left in the local cache as
+            written, so the following write-backs of the dispatcher and ConversationHandler are skipped.
+            Without it they are read again and written blindly after the script, which may overwrite a newer
+            state written by another replica.
+
+            Args:
+                name (:obj:`str`): The conversation handler's name.
+                key (:obj:`tuple`): The conversation key the state is changed for.
+                user_id (:obj:`int`): The user who answered.
+                user_data (:obj:`RedisJsonObject`): The :attr:`telegram.ext.dispatcher.user_data` [user_id].
+                quest_type (:obj:`str`): The quest_type the answer is given for.
+                answer_key (:obj:`str`): The normalized answer, it's right if it's in session's ``answer_keys``.
+                new_session (:obj:`dict`): The user_data with the next question.
+                new_state (:obj:`any`): The new state for the given key.
+
+            Returns:
+                :obj:`tuple`: (answer was checked, answer is right, previous session)
+            """
+        conversation = self.get_conversations(name)
+        key = str(key)
+        serialized_session = json.dumps(prepare_obj_for_json(new_session))
+        channel, node_id = '', ''
+        if self._invalidator:
+            channel, node_id = self._invalidator.channel, self._invalidator.node_id
+        checked, correct, previous = self._game_step(
+            keys=[user_data.key_id, conversation.key2id(key), self.stats_key(user_id)],
+            args=[quest_type, answer_key, serialized_session, conversation.serialize(key, new_state),
+                  channel, node_id])
+
+        user_data.load(serialized_session)
+        conversation.cache(key, new_state)
+        return bool(checked), bool(correct), json.loads(previous)
 
     def update_user_data(self, user_id: int, data: Dict) -> None:
         """Will update the user_data (if changed).
@@ -118,8 +294,11 @@ class RedisPersistence(BasePersistence):
                 user_id (:obj:`int`): The user the data might have been changed for.
                 data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.user_data` [user_id].
             """
-        if isinstance(data, RedisDict):
-            data.flush()
+        if isinstance(data, RedisJsonObject):
+            if self._checkpoint_thread:
+                self.user_data.mark_dirty(user_id, data)
+            else:
+                data.flush()
         else:
             self.user_data[user_id] = data
 
@@ -130,8 +309,11 @@ class RedisPersistence(BasePersistence):
                 chat_id (:obj:`int`): The chat the data might have been changed for.
                 data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.chat_data` [chat_id].
             """
-        if isinstance(data, RedisDict):
-            data.flush()
+        if isinstance(data, RedisJsonObject):
+            if self._checkpoint_thread:
+                self.chat_data.mark_dirty(chat_id, data)
+            else:
+                data.flush()
         else:
             self.chat_data[chat_id] = data
 
@@ -141,10 +323,117 @@ class RedisPersistence(BasePersistence):
             Args:
                 data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.bot_data`.
             """
-        if isinstance(data, RedisDict):
+        if isinstance(data, RedisJsonObject):
             data.flush()
         else:
-            self._bot_data = RedisDict(self._redis, f'{self.id_prefix}bot_data', data.items())
+            self._bot_data = RedisDict(self._redis, f'{self.id_prefix}bot_data', data.items(),
+                                       invalidator=self._invalidator)
+            if self._invalidator:
+                self._invalidator.register(self._bot_data)
+
+    def checkpoint(self, budget: Optional[float] = None) -> None:
+        """Will write dirty user_data and chat_data by pipelined batches.
+
+            Args:
+                budget (:obj:`float`, optional): Time limit in seconds, the rest stays dirty. Default is
+                    :obj:`None` - write all.
+            """
+        start = monotonic()
+        stores = []
+        if self.store_user_data:
+            stores.append(self.user_data)
+        if self.store_chat_data:
+            stores.append(self.chat_data)
+
+        written = 0
+        for store in stores:
+            remaining = None if budget is None else max(0.0, budget - (monotonic() - start))
+            written += store.checkpoint(remaining)
+
+        self.checkpoint_duration = monotonic() - start
+        self.checkpoint_backlog = sum(store.backlog for store in stores)
+        if written or self.checkpoint_backlog:
+            logger.info(f'checkpoint: {written} written in {self.checkpoint_duration:.3f}s, '
+                        f'backlog {self.checkpoint_backlog}')
+
+    def _checkpoint_loop(self) -> None:
+        while not self._checkpoint_stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint(self.checkpoint_budget)
+            except Exception as e:
+                logger.warning(f'checkpoint failed: {e}')
+
+    def _touch(self, active: OrderedDict, key: Any) -> None:
+        if self.warm_file:
+            active[key] = None
+            active.move_to_end(key)
+            if len(active) > self.warm_size:
+                active.popitem(last=False)
+
+    def save_warm_state(self) -> None:
+        """Will write ids of recently active users and conversations to :attr:`warm_file`."""
+        conversations = {}
+        for name, key in reversed(self._active_conversations):
+            conversations.setdefault(name, []).append(key)
+        state = {
+            'saved': time(),
+            'user_data': list(reversed(self._active_users)),
+            'conversations': conversations,
+        }
+        tmp_file = f'{self.warm_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.warm_file)
+        logger.info(f'warm state: {len(self._active_users)} users, {len(self._active_conversations)} conversations '
+                    f'saved to {self.warm_file}')
+
+    def warm_up(self, batch_size: int = 500) -> Dict[str, Any]:
+        """Will prefetch users and conversations saved by :meth:`flush` to the local cache by pipelined batches.
+            Call it after handlers are added and before polling. Cache hit ratio is logged
+            :attr:`warm_report_after` seconds later.
+
+            Returns:
+                :obj:`dict`: users and conversations found / saved and the warmup time in seconds
+            """
+        if not self.warm_file or not os.path.exists(self.warm_file):
+            return {}
+
+        start = monotonic()
+        with open(self.warm_file) as f:
+            state = json.load(f)
+
+        users = state.get('user_data', [])
+        result = {'users': 0, 'saved_users': len(users), 'conversations': 0, 'saved_conversations': 0}
+        if self.store_user_data and self.user_data.local_cache:
+            result['users'] = self.user_data.prefetch(users, batch_size)
+            for user_id in reversed(users):
+                self._touch(self._active_users, user_id)
+        for name, keys in state.get('conversations', {}).items():
+            result['conversations'] += self.get_conversations(name).prefetch(keys, batch_size)
+            result['saved_conversations'] += len(keys)
+            for key in reversed(keys):
+                self._touch(self._active_conversations, (name, key))
+        result['seconds'] = monotonic() - start
+
+        logger.info(f"warm up: {result['users']}/{result['saved_users']} users, "
+                    f"{result['conversations']}/{result['saved_conversations']} conversations "
+                    f"in {result['seconds']:.3f}s (saved {time() - state.get('saved', time()):.0f}s ago)")
+        if self.warm_report_after:
+            timer = Timer(self.warm_report_after, self.log_cache_info)
+            timer.daemon = True
+            timer.start()
+        return result
+
+    def log_cache_info(self) -> None:
+        """Will log cache hit ratio of user_data and conversations."""
+        stores = dict(self.conversations)
+        if self.store_user_data:
+            stores['user_data'] = self.user_data
+        for name, store in stores.items():
+            info = store.cache_info()
+            hit_ratio = 1 - info['misses'] / info['lookups'] if info['lookups'] else 0.0
+            logger.info(f"cache {name}: hit ratio {hit_ratio:.1%} of {info['lookups']} lookups, "
+                        f"{info['cached']} cached")
 
     def flush(self) -> None:
         """Will be called by :class:`telegram.ext.Updater` upon receiving a stop signal. Gives the
@@ -152,14 +441,29 @@ class RedisPersistence(BasePersistence):
             is not of any importance just pass will be sufficient.
             """
 
-        if self.store_user_data:
-            self.user_data.flush()
+        if self._checkpoint_thread:
+            self._checkpoint_stop.set()
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+            self.checkpoint()
+        else:
+            if self.store_user_data:
+                self.user_data.flush()
 
-        if self.store_chat_data:
-            self.chat_data.flush()
+            if self.store_chat_data:
+                self.chat_data.flush()
 
         if self.store_bot_data:
             self.bot_data.flush()
 
         for conversation in self.conversations.values():
             conversation.flush()
+
+        if self.warm_file:
+            try:
+                self.save_warm_state()
+            except OSError as e:
+                logger.warning(f'failed to save warm state: {e}')
+
+        if self._invalidator:
+            self._invalidator.stop()
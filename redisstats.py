@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
+
+from redis.exceptions import NoScriptError
+
+from redis_util import redis_from_url_or_object, hash_tag, StrictRedis
+from redis_pool import is_cluster
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS: user stats hash
+# ARGV: quest_type
+# returns new best streak or 0, leaderboard is updated by caller: it's in other cluster slot
+STREAK_SCRIPT = """
+local streak = redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':streak', 1)
+if streak > tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':best_streak') or 0) then
+    redis.call('HSET', KEYS[1], ARGV[1] .. ':best_streak', streak)
+    return streak
+end
+return 0
+"""
+
+
+class RedisStats(object):
+    """
+        Per-user answer statistics and leaderboards, stored apart from user_data
+
+        Every user has a hash {bot_id}:stats:{user_id} (user_id is hash tag with hash_tags)
+        with fields {quest_type}:{counter}:
+            right, wrong - answers count (also written by :meth:`RedisPersistence.game_step`)
+            streak, best_streak - right answers in a row
+            time_ms, timed - total response time and count of timed answers
+            guesses - tries of guess_number, its right is count of won games (see :meth:`count`)
+        Leaderboards are sorted sets by user_id:
+            {bot_id}:stats:top:{quest_type}, {bot_id}:stats:top:all - right answers count
+            {bot_id}:stats:streak:{quest_type} - best streak
+
+        Writes are fire-and-forget: :meth:`record` only put answer into the queue,
+        background thread send them to Redis by pipelined batches
+        Ask times are kept only for asked_size users that were asked recently
+        Redis Cluster pipeline doesn't load scripts, so the streak script is loaded on all masters
+        before the batch, and a streak that got NOSCRIPT (failover to a fresh replica) is run again directly
+    """
+
+    ALL = 'all'
+
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], bot_id: Optional[str] = None,
+                 batch_size: int = 100, flush_interval: float = 1.0, hash_tags: bool = False,
+                 asked_size: int = 10000):
+        self.id_prefix = f'bot_{bot_id}:' if bot_id else ''
+        self.hash_tags = hash_tags
+        self._redis = redis_from_url_or_object(redis_url)
+        self._streak = self._redis.register_script(STREAK_SCRIPT)
+        self.cluster = is_cluster(self._redis)
+        self._script_loaded = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.asked_size = asked_size
+        self._asked: Dict[int, float] = OrderedDict()
+        self._asked_lock = Lock()
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name='redis_stats', daemon=True)
+        self._thread.start()
+
+    def user_key(self, user_id: int) -> str:
+        return f'{self.id_prefix}stats:{hash_tag(user_id) if self.hash_tags else user_id}'
+
+    def top_key(self, quest_type: str) -> str:
+        return f'{self.id_prefix}stats:top:{quest_type}'
+
+    def streak_key(self, quest_type: str) -> str:
+        return f'{self.id_prefix}stats:streak:{quest_type}'
+
+    @property
+    def names_key(self) -> str:
+        return f'{self.id_prefix}stats:names'
+
+    def asked(self, user_id: int) -> None:
+        """
+        remember when question was asked, for response time of the next answer
+        """
+        with self._asked_lock:
+            self._asked.pop(user_id, None)
+            self._asked[user_id] = monotonic()
+            if len(self._asked) > self.asked_size:
+                self._asked.popitem(last=False)
+
+    def record(self, user_id: int, quest_type: str, correct: bool,
+               name: Optional[str] = None, counted: bool = False) -> None:
+        """
+        queue answer outcome, counted=True if right/wrong counters are already incremented
+        """
+        with self._asked_lock:
+            asked = self._asked.pop(user_id, None)
+        response_ms = None if asked is None else round((monotonic() - asked) * 1000)
+        self._queue.put((self._write, (user_id, quest_type, correct, name, counted, response_ms)))
+
+    def count(self, user_id: int, quest_type: str, counter: str, n: int = 1) -> None:
+        """
+        queue increment of a counter, that isn't an answer: streak and response time are not changed
+        """
+        self._queue.put((self._write_count, (user_id, quest_type, counter, n)))
+
+    def _write_count(self, pipe, streaks, user_id, quest_type, counter, n) -> None:
+        pipe.hincrby(self.user_key(user_id), f'{quest_type}:{counter}', n)
+
+    def _write(self, pipe, streaks, user_id, quest_type, correct, name, counted, response_ms) -> None:
+        user_key = self.user_key(user_id)
+        if not counted:
+            pipe.hincrby(user_key, f'{quest_type}:{"right" if correct else "wrong"}', 1)
+        if response_ms is not None:
+            pipe.hincrby(user_key, f'{quest_type}:time_ms', response_ms)
+            pipe.hincrby(user_key, f'{quest_type}:timed', 1)
+        if correct:
+            streaks.append((len(pipe), user_id, quest_type))
+            if self.cluster:
+                pipe.execute_command('EVALSHA', self._streak.sha, 1, user_key, quest_type)
+            else:
+                self._streak(keys=[user_key], args=[quest_type], client=pipe)
+            pipe.zincrby(self.top_key(quest_type), 1, user_id)
+            pipe.zincrby(self.top_key(self.ALL), 1, user_id)
+        else:
+            pipe.hset(user_key, f'{quest_type}:streak', 0)
+        if name:
+            pipe.hset(self.names_key, user_id, name)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - monotonic())))
+                except Empty:
+                    break
+
+            try:
+                if self.cluster and not self._script_loaded:
+                    # SCRIPT LOAD is sent to all masters
+                    self._redis.script_load(STREAK_SCRIPT)
+                    self._script_loaded = True
+                pipe = self._redis.pipeline(transaction=False)
+                streaks = []
+                for item in batch:
+                    if item is not None:
+                        write, args = item
+                        write(pipe, streaks, *args)
+                if self.cluster:
+                    result = self._execute_cluster(pipe, streaks)
+                else:
+                    result = pipe.execute()
+
+                pipe = self._redis.pipeline(transaction=False)
+                for index, user_id, quest_type in streaks:
+                    if result[index]:
+                        pipe.zadd(self.streak_key(quest_type), {user_id: result[index]})
+                pipe.execute()
+            except Exception as e:
+                logger.warning(f'failed to write {len(batch)} stats records: {e}')
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _execute_cluster(self, pipe, streaks) -> list:
+        result = pipe.execute(raise_on_error=False)
+        for index, user_id, quest_type in streaks:
+            if isinstance(result[index], NoScriptError):
+                self._script_loaded = False
+                result[index] = self._streak(keys=[self.user_key(user_id)], args=[quest_type])
+        for item in result:
+            if isinstance(item, Exception):
+                raise item
+        return result
+
+    def flush(self) -> None:
+        """
+        wait until all queued records are written
+        """
+        self._queue.put(None)
+        self._queue.join()
+
+    def user_stats(self, user_id: int) -> Dict[str, Dict[str, int]]:
+        """
+        counters of the user grouped by quest_type
+        """
+        result = {}
+        for field, value in self._redis.hgetall(self.user_key(user_id)).items():
+            quest_type, counter = field.rsplit(':', 1)
+            result.setdefault(quest_type, {})[counter] = int(value)
+        return result
+
+    def top(self, quest_type: str = ALL, n: int = 10) -> List[Tuple[str, int]]:
+        """
+        top n users as (name, right answers count)
+        """
+        return self._top(self.top_key(quest_type), n)
+
+    def top_streak(self, quest_type: str, n: int = 10) -> List[Tuple[str, int]]:
+        """
+        top n users as (name, best streak)
+        """
+        return self._top(self.streak_key(quest_type), n)
+
+    def _top(self, key: str, n: int) -> List[Tuple[str, int]]:
+        top = self._redis.zrevrange(key, 0, n - 1, withscores=True)
+        if not top:
+            return []
+        names = self._redis.hmget(self.names_key, [user_id for user_id, _ in top])
+        return [(name or user_id, int(score)) for (user_id, score), name in zip(top, names)]
@@ -0,0 +1,218 @@
+from collections.abc import MutableMapping
+from enum import Enum
+from itertools import chain
+from typing import Optional, Union, Iterable, Iterator
+
+from redis_util import RedisJsonObject, CacheInvalidator, redis_from_url_or_object, StrictRedis
+
+
+class Game(str, Enum):
+    """
+        Values of choice and quest_type, one shared object for all sessions instead of a str per session
+    """
+
+    GUESS_NUMBER = 'guess_number'
+    MULTI1 = 'multi1'
+    MULTI2 = 'multi2'
+    MULTI3 = 'multi3'
+    TWO_ACTIONS = 'two_actions'
+    RANDOM = 'random'
+
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+def intern_game(value: any) -> any:
+    return Game._value2member_map_.get(value, value) if isinstance(value, str) else value
+
+
+def to_tuples(value: any) -> any:
+    """
+    lists from json to tuples: less memory and comparable with answers made by the bot
+    """
+    if isinstance(value, list):
+        return tuple(map(to_tuples, value))
+    return value
+
+
+class Quest(object):
+    """
+        Question fields of the session, common for all games (guess_number uses only right_answer)
+        Subclass per game adds its own fields to __slots__ and sets quest_type
+    """
+
+    __slots__ = ('question', 'right_answer', 'answer_keys')
+    quest_type: Optional[Game] = None
+    fields = __slots__
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = tuple(chain.from_iterable(c.__dict__.get('__slots__', ()) for c in reversed(cls.__mro__)))
+
+
+class Multi1Quest(Quest):
+    __slots__ = ()
+    quest_type = Game.MULTI1
+
+
+class TwoActionsQuest(Quest):
+    __slots__ = ()
+    quest_type = Game.TWO_ACTIONS
+
+
+class Multi2Quest(Quest):
+    __slots__ = ('q', 'r')
+    quest_type = Game.MULTI2
+
+
+class Multi3Quest(Quest):
+    __slots__ = ('answers',)
+    quest_type = Game.MULTI3
+
+
+quests = {cls.quest_type: cls for cls in (Multi1Quest, TwoActionsQuest, Multi2Quest, Multi3Quest)}
+
+
+class RedisSession(RedisJsonObject, MutableMapping):
+    """
+        Compact user session for RedisDictStore(dict_class=RedisSession), replacement of RedisDict
+        Behaves like a dict, but keeps choice and question fields in __slots__ of Quest object
+        by quest_type, other keys go to extra dict
+        When quest_type is changed, fields of the previous game that the new one don't have go to extra,
+        so they are kept like in a dict (analyze_keys.py --trim drops them)
+        Unlike a dict, keys are iterated (and dumped) in fixed order: choice, quest_type, question fields
+        of the game, then other keys in insertion order, whatever the order of keys on load was
+    """
+
+    __slots__ = ('_redis', 'key_id', '_serialized', '_invalidator', 'choice', 'quest', 'extra')
+
+    def __init__(self, redis_url: Union[str, 'StrictRedis'], key_id: str, seq: Optional[Iterable] = None,
+                 invalidator: Optional[CacheInvalidator] = None, **kwargs):
+        self._redis = redis_from_url_or_object(redis_url)
+        self.key_id = key_id
+        self._serialized = None
+        self._invalidator = invalidator
+        self.quest = None
+        self.extra = None
+        if seq is not None:
+            self.update(seq)
+        if kwargs:
+            self.update(kwargs)
+        if not self:
+            self.read()
+
+    def _set_quest_type(self, quest_type: any) -> None:
+        cls = quests.get(quest_type, Quest)
+        quest = self.quest
+        if type(quest) is cls:
+            return
+        self.quest = cls()
+        if quest is not None:
+            for field in quest.fields:
+                if not hasattr(quest, field):
+                    continue
+                if field in self.quest.fields:
+                    setattr(self.quest, field, getattr(quest, field))
+                else:
+                    if self.extra is None:
+                        self.extra = {}
+                    self.extra[field] = getattr(quest, field)
+        if self.extra:
+            for field in self.quest.fields:
+                if field in self.extra:
+                    setattr(self.quest, field, to_tuples(self.extra.pop(field)))
+
+    def __getitem__(self, key: any) -> any:
+        if key == 'choice':
+            try:
+                return self.choice
+            except AttributeError:
+                raise KeyError(key)
+
+        quest = self.quest
+        if key == 'quest_type':
+            if quest is not None and quest.quest_type is not None:
+                return quest.quest_type
+        elif quest is not None and key in quest.fields:
+            try:
+                return getattr(quest, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: any, value: any) -> None:
+        if key == 'choice':
+            self.choice = intern_game(value)
+            return
+
+        if key == 'quest_type':
+            value = intern_game(value)
+            if value in quests:
+                self._set_quest_type(value)
+                if self.extra is not None:
+                    self.extra.pop(key, None)
+                return
+            if self.quest is not None and self.quest.quest_type is not None:
+                self._set_quest_type(None)
+        elif key in Quest.fields or (self.quest is not None and key in self.quest.fields):
+            if self.quest is None:
+                self.quest = Quest()
+            if key in self.quest.fields:
+                setattr(self.quest, key, to_tuples(value))
+                return
+
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key: any) -> None:
+        if key == 'choice':
+            try:
+                del self.choice
+                return
+            except AttributeError:
+                raise KeyError(key)
+
+        quest = self.quest
+        if key == 'quest_type':
+            if quest is not None and quest.quest_type is not None:
+                self._set_quest_type(None)
+                return
+        elif quest is not None and key in quest.fields:
+            try:
+                delattr(quest, key)
+                return
+            except AttributeError:
+                raise KeyError(key)
+
+        if self.extra is None:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __iter__(self) -> Iterator[str]:
+        if hasattr(self, 'choice'):
+            yield 'choice'
+        quest = self.quest
+        if quest is not None:
+            if quest.quest_type is not None:
+                yield 'quest_type'
+            for field in quest.fields:
+                if hasattr(quest, field):
+                    yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.to_dict()!r})'
+
+    def clear(self) -> None:
+        if hasattr(self, 'choice'):
+            del self.choice
+        self.quest = None
+        self.extra = None
@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from analyze_keys import KeyspaceAnalyzer
+
+fakeredis = pytest.importorskip('fakeredis')
+
+SESSION = {'choice': 'multi1', 'quest_type': 'multi1', 'question': '7 * 4 = ?',
+           'right_answer': '28', 'answer_keys': ['28']}
+
+
+def test_rewrite_skips_sessions_in_current_format():
+    redis = fakeredis.FakeStrictRedis(decode_responses=True)
+    redis.set('user_data:1', json.dumps(SESSION))
+    redis.set('user_data:2', json.dumps({key: SESSION[key] for key in reversed(SESSION)}))
+
+    analyzer = KeyspaceAnalyzer(redis, rewrite=True)
+    analyzer.run()
+
+    assert analyzer.actions == {'rewrite': 1}
+    assert redis.get('user_data:2') == redis.get('user_data:1') == json.dumps(SESSION)
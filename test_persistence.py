@@ -0,0 +1,71 @@
+import json
+from queue import Queue
+from unittest import mock
+
+import pytest
+from telegram import Bot
+from telegram.ext import Dispatcher
+
+from redispersistence import RedisPersistence
+from session import RedisSession
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def make_dispatcher(redis, **kwargs):
+    persistence = RedisPersistence(redis, store_chat_data=False, store_bot_data=False,
+                                   user_data_class=RedisSession, **kwargs)
+    return Dispatcher(Bot('123:abc'), Queue(), persistence=persistence), persistence
+
+
+def write_sessions(redis, user_ids):
+    for user_id in user_ids:
+        # in insertion order of a dict, like number.save_session writes them
+        session = {'choice': 'multi1', 'quest_type': 'multi1', 'question': f'{user_id} * 2 = ?',
+                   'right_answer': str(user_id * 2), 'answer_keys': [str(user_id * 2)]}
+        redis.set(f'user_data:{user_id}', json.dumps(session))
+
+
+def test_shutdown_writes_only_changed_sessions():
+    redis = fakeredis.FakeStrictRedis(decode_responses=True)
+    write_sessions(redis, range(1000))
+    dispatcher, persistence = make_dispatcher(redis, checkpoint_interval=3600)
+    assert persistence.user_data.prefetch(range(1000)) == 1000
+
+    for user_id in (1, 2, 3, 4):
+        dispatcher.user_data[user_id]['question'] = 'changed before checkpoint'
+        persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+    persistence.checkpoint()
+    for user_id in (5, 6, 7):
+        dispatcher.user_data[user_id]['question'] = 'changed after checkpoint'
+        persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+
+    # what Updater.signal_handler does
+    with mock.patch.object(RedisSession, 'write', autospec=True, side_effect=RedisSession.write) as write:
+        dispatcher.update_persistence()
+        assert persistence.user_data.backlog == 3
+        persistence.flush()
+    assert sorted(call.args[0].key_id for call in write.call_args_list) == ['user_data:5', 'user_data:6', 'user_data:7']
+    assert json.loads(redis.get('user_data:7'))['question'] == 'changed after checkpoint'
+    assert json.loads(redis.get('user_data:4'))['question'] == 'changed before checkpoint'
+
+
+def test_warm_file_lists_recently_active_users(tmp_path):
+    redis = fakeredis.FakeStrictRedis(decode_responses=True)
+    write_sessions(redis, range(1000))
+    warm_file = str(tmp_path / 'warm.json')
+    dispatcher, persistence = make_dispatcher(redis, checkpoint_interval=3600, warm_file=warm_file)
+    assert persistence.user_data.prefetch(range(1000)) == 1000
+
+    for user_id in (5, 6, 7):
+        # what ConversationHandler and the dispatcher do for an update of the user
+        persistence.update_conversation('main', (user_id, user_id), 2)
+        dispatcher.user_data[user_id]['question'] = 'changed'
+        persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+
+    dispatcher.update_persistence()
+    persistence.flush()
+    with open(warm_file) as f:
+        state = json.load(f)
+    assert state['user_data'] == ['7', '6', '5']
+    assert state['conversations'] == {'main': ['(7, 7)', '(6, 6)', '(5, 5)']}
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from redis_util import CacheInvalidator, RedisDictStore
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def make_node(server, backoff: float = 0.05):
+    redis = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    invalidator = CacheInvalidator(redis, 'invalidate', backoff=backoff)
+    store = RedisDictStore(redis, 'user_data', invalidator=invalidator)
+    invalidator.register(store)
+    invalidator.start()
+    return invalidator, store
+
+
+def test_invalidator_resubscribes_after_connection_loss():
+    server = fakeredis.FakeServer()
+    invalidator_a, store_a = make_node(server)
+    invalidator_b, store_b = make_node(server, backoff=0.5)
+    try:
+        store_a[1] = {'choice': 'multi1'}
+        store_a[2] = {'choice': 'multi1'}
+        assert store_b[1]['choice'] == 'multi1'
+        assert store_b[2]['choice'] == 'multi1'
+        store_b[2]['choice'] = 'multi3'
+        store_b.mark_dirty(2)
+
+        server.connected = False
+        time.sleep(1.5)
+        server.connected = True
+        # written while B is not subscribed again: B never gets this message
+        store_a[1] = {'choice': 'multi2'}
+
+        assert wait_for(lambda: invalidator_b.subscribes >= 2)
+        assert invalidator_b._thread.is_alive()
+        assert store_b[1]['choice'] == 'multi2'
+        # not written yet, so it's kept
+        assert store_b[2]['choice'] == 'multi3'
+
+        store_a[1] = {'choice': 'two_actions'}
+        assert wait_for(lambda: store_b[1]['choice'] == 'two_actions')
+    finally:
+        invalidator_a.stop()
+        invalidator_b.stop()
+
+
+def test_invalidator_stop():
+    invalidator, _ = make_node(fakeredis.FakeServer())
+    assert invalidator.subscribes == 1
+    invalidator.stop()
+    assert invalidator._thread is None
+
+
+def test_dict_read_last_is_returned_while_redis_is_unavailable():
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    redis.set('user_data:1', '{"choice": "multi1"}')
+    store = RedisDictStore(redis, 'user_data')
+    assert not store.local_cache
+    assert store[1]['choice'] == 'multi1'
+
+    server.connected = False
+    assert store[1]['choice'] == 'multi1'
+    with pytest.raises(ConnectionError):
+        store[1].flush()
+    with pytest.raises(ConnectionError):
+        store[2]
+
+    server.connected = True
+    redis.set('user_data:1', '{"choice": "multi2"}')
+    assert store[1]['choice'] == 'multi2'
@@ -0,0 +1,91 @@
+import json
+
+from redis import StrictRedis
+
+from session import RedisSession, Game, Multi2Quest, Multi3Quest
+
+MULTI2 = {'choice': 'multi2', 'quest_type': 'multi2', 'question': '12 = ? x ?; ? x ?',
+          'right_answer': '2 x 6; 3 x 4', 'answer_keys': ['2 x 6; 3 x 4'], 'q': 12, 'r': [[2, 6], [3, 4]]}
+
+
+def make_session(seq=None) -> RedisSession:
+    # the session doesn't touch Redis until it's read or flushed
+    return RedisSession(StrictRedis(), 'user_data:1', seq)
+
+
+def loaded(value: dict) -> RedisSession:
+    session = make_session({'choice': None})
+    session.load(json.dumps(value))
+    return session
+
+
+def test_load_in_any_key_order():
+    expected = loaded(MULTI2)
+    for keys in (list(MULTI2), list(reversed(MULTI2)), ['q', 'r', 'choice', 'question', 'quest_type',
+                                                        'right_answer', 'answer_keys']):
+        session = loaded({key: MULTI2[key] for key in keys})
+        assert isinstance(session.quest, Multi2Quest)
+        assert not session.extra
+        assert session.to_dict() == expected.to_dict()
+        assert session['r'] == ((2, 6), (3, 4))
+
+
+def test_iteration_order_is_fixed():
+    session = loaded({'level': 3, **{key: MULTI2[key] for key in reversed(MULTI2)}})
+    assert list(session) == ['choice', 'quest_type', 'question', 'right_answer', 'answer_keys', 'q', 'r', 'level']
+    assert list(json.loads(session.dump())) == list(session)
+
+
+def test_dump_of_loaded_session_is_unchanged():
+    session = loaded(MULTI2)
+    serialized_value = session.dump()
+    session = make_session({'choice': None})
+    session.load(serialized_value)
+    session._invalidator = object()
+    assert session.dump() is None
+
+
+def test_switch_game_keeps_previous_fields():
+    session = loaded(MULTI2)
+    session.update({'quest_type': 'multi3', 'question': '12\n= ? x ?', 'answers': [[[2, 6]]]})
+    assert isinstance(session.quest, Multi3Quest)
+    assert session['quest_type'] is Game.MULTI3
+    assert session['q'] == 12
+    assert session['r'] == ((2, 6), (3, 4))
+    assert session['right_answer'] == MULTI2['right_answer']
+    assert session['answers'] == (((2, 6),),)
+    assert list(session) == ['choice', 'quest_type', 'question', 'right_answer', 'answer_keys', 'answers', 'q', 'r']
+
+
+def test_switch_back_takes_fields_from_extra():
+    session = loaded(MULTI2)
+    session['quest_type'] = 'multi1'
+    assert set(session.extra) == {'q', 'r'}
+    session['quest_type'] = 'multi2'
+    assert isinstance(session.quest, Multi2Quest)
+    assert not session.extra
+    assert session.to_dict() == loaded(MULTI2).to_dict()
+
+
+def test_unknown_quest_type_and_delete():
+    session = loaded(MULTI2)
+    session['quest_type'] = 'chess'
+    assert session['quest_type'] == 'chess'
+    assert session['q'] == 12
+    del session['quest_type']
+    assert 'quest_type' not in session
+    assert session['r'] == ((2, 6), (3, 4))
+
+
+def test_plain_dict_compatibility():
+    session = make_session({'choice': 'multi1'})
+    plain = {'choice': 'multi1'}
+    for target in (session, plain):
+        target.update({'quest_type': 'multi2', 'q': 12, 'question': 'q'})
+        target['quest_type'] = 'multi1'
+        target['question'] = 'next'
+        target.pop('q')
+        target.setdefault('level', 1)
+    assert dict(session) == plain
+    session.clear()
+    assert len(session) == 0 and dict(session) == {}